@@ -25,6 +25,15 @@ kStationType = 'Davis'
 kCommPort = "/dev/ttyUSB0"
 #kCommPort = "Choose"
 
+## Several stations in one process: list one dictionary per console.
+## 'port' is the serial device or "host:port"; any other key overrides
+## the setting of the same name below for that station only.
+##
+#kStations = [
+#	{'name': 'roof', 'port': "/dev/ttyUSB0", 'kCSVFile': "/dev/shm/roof.csv"},
+#	{'name': 'barn', 'port': "192.168.1.20:4001", 'kWundergroundUserID': "barnid"},
+#]
+
 ## ------------------------------------------
 
 ##
@@ -52,13 +61,114 @@ kWeatherServer = 0         ## should we turn on the weather server?
 ## Update Interval (in minutes)
 kWunderground_UpdateInterval = 15 * 60
 
+## RapidFire: upload every kWunderground_RealTimeInterval seconds to
+## rtupdate.wunderground.com, reusing one HTTP/1.1 connection, instead of
+## every kWunderground_UpdateInterval.  Uploads follow the samples, so
+## lower kUpdateInterval too for anything faster than it.
+kWunderground_RealTime = 0
+kWunderground_RealTimeInterval = 5
+
+## upload host when not the default; python wuserver.py stands in for it
+#kWunderground_Host = "localhost:8080"
+
+## Uploads that fail, and samples caught up from the archive, are kept
+## here and sent with their own time once uploads get through again,
+## kSpool_Batch at a time and at most kSpool_Rate a second
+## (python spool.py <file> lists them); None to drop them.
+kWunderground_Spool = "/var/tmp/weather_spool.txt"
+kSpool_Batch = 20
+kSpool_Rate = 2.0
+
 ## Update Interval (in seconds)
 #kCSVFile = None
 kCSVFile = "/dev/shm/current.csv"
 kCSV_UpdateInterval = 15 * 60
-kCSV_MaxLines = 20
+kCSV_MaxLines = 20					## None keeps every row
+## the file may grow this many rows past kCSV_MaxLines before it is
+## rewritten (None for a quarter of kCSV_MaxLines)
+kCSV_Slack = None
+
+## Keep a file.csv.idx index of the CSV file so a time range can be
+## read without scanning it (python csvindex.py <file> <from> <to>),
+## with one entry per kCSV_IndexBucket seconds of rows.
+kCSV_Index = 1
+kCSV_IndexBucket = 3600
+
+## Continuous LOOP streaming: send LOOP once and read the packets
+## the console sends back to back, instead of one LOOP per sample.
+kLoopStream = 1
+kLoopStreamCount = 65535
+
+## On (re)start, download the archive records the console stored
+## while we were not polling, going back at most this many seconds.
+## (0 turns the catch-up off)
+kArchiveCatchup = 24 * 3600
+
+## After a serial error go straight back to polling, keeping the model,
+## calibration and sample history.  After this many resumes in a row
+## without a good sample, redo the full handshake.
+kResumeAttempts = 3
+
+## Each updater (Wunderground, CSV, ...) runs on its own thread behind a
+## queue of kUpdaterQueue samples, so a slow upload or disk never delays
+## polling.  When a queue is full: "drop-oldest", "conflate" (keep only
+## the latest update) or "block".  Wunderground and the shell display
+## always conflate.
+kAsyncUpdaters = 1
+kUpdaterQueue = 16
+kUpdaterPolicy = "drop-oldest"
 
 ## Update Interval (in seconds)
 kShell_UpdateInterval = 86400
+
+## The sinks every sample goes to: "wunderground", "csv", "shell",
+## "server" (the weather server) or "module.Class" for an Updater of
+## your own.  Only the modules of the sinks listed are loaded.  "csv"
+## still needs kCSVFile and "server" kWeatherServer, here or in a
+## station's overrides.  The seconds between updates come from the
+## settings above when the sink is built, so overrides of those apply;
+## (name, seconds) fixes them here instead.
+kSinks = ['wunderground', 'csv', 'shell', 'server']
 kUpdateInterval = 30
 
+## After a poll overran kUpdateInterval: "skip" the missed polls or
+## "catchup" by polling back to back.
+kSchedulePolicy = "skip"
+
+## The console clock is only rewritten when it is predicted to be off
+## by more than kClockMaxError seconds.  It is read at most every
+## kClockCheckInterval seconds (when streaming, only between LOOP runs).
+kClockMaxError = 30
+kClockCheckInterval = 6 * 3600
+
+
+## Extra rolling aggregates set on every sample, on top of the built-in
+## baro_diff and max/min wind, temperature and humidity (rain totals are
+## kept by the rain accumulator, see kRainState):
+## (name, field, kind, window in seconds).  kind is max, min, mean, sum,
+## count or delta over the window, or since_midnight (window unused).
+kAggregates = [
+	('wind_avg_2m', 'wind_speed', 'mean', 2 * 60),
+	('wind_avg_10m', 'wind_speed', 'mean', 10 * 60),
+	('wind_gust_10m', 'wind_gust_speed', 'max', 10 * 60),
+	('baro_tendency_3h', 'barometer', 'delta', 3 * 3600),
+	]
+
+## Rain is counted from the console's rain counter, allowing for the
+## counter wrapping or being reset, into rain_diff (last hour), rain_rate
+## (in/hr), rain_24h, rain_hour/day/month/year and rain_today (the same
+## as rain_day).  The totals are saved here so
+## they survive a restart.  (print them with: python rain.py <file>)
+kRainState = "/var/tmp/weather_rain.json"
+
+## Every sample is appended to this binary file (None to turn it off),
+## and the rolling window is reloaded from it on startup.  Appended records
+## are fsync()ed at most every kSampleStoreSync seconds.
+## (print it with: python recordfile.py <file>)
+kSampleStore = "/var/tmp/weather_samples.dat"
+kSampleStoreSync = 60
+
+## Minute, hour and day summaries of the samples are written to
+## <kRollupStore>.minute.dat, .hour.dat and .day.dat (None to turn off).
+## (print them with: python rollup.py --level=hour <kRollupStore>)
+kRollupStore = "/var/tmp/weather_rollup"
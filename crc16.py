@@ -0,0 +1,193 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args]
+
+	CRC-16/CCITT engine used to check Davis console frames.  A frame is
+	valid when the CRC of its payload plus the trailing CRC bytes is zero.
+
+	--bench      run the per-frame microbenchmark
+"""
+
+
+import os, sys, string, time, getopt, struct
+from log import *
+
+try:
+	from binascii import crc_hqx
+except ImportError:
+	crc_hqx = None
+
+
+crc_table = [
+0x0,  0x1021,  0x2042,  0x3063,  0x4084,  0x50a5,  0x60c6,  0x70e7,
+0x8108,  0x9129,  0xa14a,  0xb16b,  0xc18c,  0xd1ad,  0xe1ce,  0xf1ef,
+0x1231,  0x210,  0x3273,  0x2252,  0x52b5,  0x4294,  0x72f7,  0x62d6,
+0x9339,  0x8318,  0xb37b,  0xa35a,  0xd3bd,  0xc39c,  0xf3ff,  0xe3de,
+0x2462,  0x3443,  0x420,  0x1401,  0x64e6,  0x74c7,  0x44a4,  0x5485,
+0xa56a,  0xb54b,  0x8528,  0x9509,  0xe5ee,  0xf5cf,  0xc5ac,  0xd58d,
+0x3653,  0x2672,  0x1611,  0x630,  0x76d7,  0x66f6,  0x5695,  0x46b4,
+0xb75b,  0xa77a,  0x9719,  0x8738,  0xf7df,  0xe7fe,  0xd79d,  0xc7bc,
+0x48c4,  0x58e5,  0x6886,  0x78a7,  0x840,  0x1861,  0x2802,  0x3823,
+0xc9cc,  0xd9ed,  0xe98e,  0xf9af,  0x8948,  0x9969,  0xa90a,  0xb92b,
+0x5af5,  0x4ad4,  0x7ab7,  0x6a96,  0x1a71,  0xa50,  0x3a33,  0x2a12,
+0xdbfd,  0xcbdc,  0xfbbf,  0xeb9e,  0x9b79,  0x8b58,  0xbb3b,  0xab1a,
+0x6ca6,  0x7c87,  0x4ce4,  0x5cc5,  0x2c22,  0x3c03,  0xc60,  0x1c41,
+0xedae,  0xfd8f,  0xcdec,  0xddcd,  0xad2a,  0xbd0b,  0x8d68,  0x9d49,
+0x7e97,  0x6eb6,  0x5ed5,  0x4ef4,  0x3e13,  0x2e32,  0x1e51,  0xe70,
+0xff9f,  0xefbe,  0xdfdd,  0xcffc,  0xbf1b,  0xaf3a,  0x9f59,  0x8f78,
+0x9188,  0x81a9,  0xb1ca,  0xa1eb,  0xd10c,  0xc12d,  0xf14e,  0xe16f,
+0x1080,  0xa1,  0x30c2,  0x20e3,  0x5004,  0x4025,  0x7046,  0x6067,
+0x83b9,  0x9398,  0xa3fb,  0xb3da,  0xc33d,  0xd31c,  0xe37f,  0xf35e,
+0x2b1,  0x1290,  0x22f3,  0x32d2,  0x4235,  0x5214,  0x6277,  0x7256,
+0xb5ea,  0xa5cb,  0x95a8,  0x8589,  0xf56e,  0xe54f,  0xd52c,  0xc50d,
+0x34e2,  0x24c3,  0x14a0,  0x481,  0x7466,  0x6447,  0x5424,  0x4405,
+0xa7db,  0xb7fa,  0x8799,  0x97b8,  0xe75f,  0xf77e,  0xc71d,  0xd73c,
+0x26d3,  0x36f2,  0x691,  0x16b0,  0x6657,  0x7676,  0x4615,  0x5634,
+0xd94c,  0xc96d,  0xf90e,  0xe92f,  0x99c8,  0x89e9,  0xb98a,  0xa9ab,
+0x5844,  0x4865,  0x7806,  0x6827,  0x18c0,  0x8e1,  0x3882,  0x28a3,
+0xcb7d,  0xdb5c,  0xeb3f,  0xfb1e,  0x8bf9,  0x9bd8,  0xabbb,  0xbb9a,
+0x4a75,  0x5a54,  0x6a37,  0x7a16,  0xaf1,  0x1ad0,  0x2ab3,  0x3a92,
+0xfd2e,  0xed0f,  0xdd6c,  0xcd4d,  0xbdaa,  0xad8b,  0x9de8,  0x8dc9,
+0x7c26,  0x6c07,  0x5c64,  0x4c45,  0x3ca2,  0x2c83,  0x1ce0,  0xcc1,
+0xef1f,  0xff3e,  0xcf5d,  0xdf7c,  0xaf9b,  0xbfba,  0x8fd9,  0x9ff8,
+0x6e17,  0x7e36,  0x4e55,  0x5e74,  0x2e93,  0x3eb2,  0xed1,  0x1ef0,
+]
+
+## size of a LOOP frame including the 0x01 header byte
+kFrameSize = 18
+
+## 64K entry table that consumes a whole 16 bit word per lookup,
+## built on first use.
+_wide_table = None
+
+def _build_wide_table():
+	global _wide_table
+	if _wide_table is None:
+		table = [0] * 65536
+		for v in xrange(65536):
+			accum = ((v & 0xff) << 8) ^ crc_table[v >> 8]
+			table[v] = ((accum & 0xff) << 8) ^ crc_table[accum >> 8]
+		_wide_table = table
+	return _wide_table
+
+
+def compute_crc_bytewise(str):
+	"""the original byte at a time implementation, kept as a reference"""
+	accum = 0L
+	for c in str:
+		accum_high = (accum & 65280) / 256
+		comb_val = int(accum_high) ^ ord(c)
+		crc_tbl = long(crc_table[comb_val])
+		accum_low = (accum & 255) * 256
+		accum = accum_low ^ crc_tbl
+	return int(accum)
+
+
+def crc16_table(data, accum=0):
+	"""pure python CRC using the wide table, two bytes per lookup"""
+	table = _build_wide_table()
+	## str() of a memoryview is its repr, not its bytes
+	if isinstance(data, memoryview): data = data.tobytes()
+	else: data = str(data)
+	n = len(data)
+	if n & 1:
+		accum = ((accum & 0xff) << 8) ^ crc_table[(accum >> 8) ^ ord(data[0])]
+		data = data[1:]
+		n = n - 1
+	for word in struct.unpack('>%dH' % (n >> 1), data):
+		accum = table[accum ^ word]
+	return accum
+
+
+def crc16(data, accum=0):
+	"""CRC of a str, buffer, bytearray or memoryview"""
+	return crc_hqx(data, accum)
+
+if crc_hqx is None:
+	crc16 = crc16_table
+
+compute_crc = crc16
+
+
+def verify_frames(data, size=kFrameSize, skip=1):
+	"""Check every size byte record in data in one call.
+
+	The first skip bytes of each record (the header) are not covered by
+	the CRC.  Returns a list with a true value for each good record and
+	a false one for each bad record; a short trailing record is ignored.
+	"""
+	view = memoryview(data)
+	crc = crc16
+	ret = []
+	for off in xrange(0, len(view) - size + 1, size):
+		ret.append(not crc(view[off+skip:off+size]))
+	return ret
+
+
+def bad_frames(data, size=kFrameSize, skip=1):
+	"""indexes of the records in data that fail the CRC check"""
+	ret = []
+	i = 0
+	for ok in verify_frames(data, size, skip):
+		if not ok: ret.append(i)
+		i = i + 1
+	return ret
+
+
+def make_frame(payload, header='\x01'):
+	"""append the CRC to payload so that the frame verifies"""
+	crc = crc16(payload)
+	return header + payload + chr(crc >> 8) + chr(crc & 0xff)
+
+
+def bench(n=20000):
+	import random
+	frames = []
+	for i in range(200):
+		payload = string.join(map(chr, [random.randrange(256) for j in range(15)]), '')
+		frames.append(make_frame(payload)[1:])
+
+	results = []
+	for name, func in (("bytewise", compute_crc_bytewise),
+										 ("wide table", crc16_table),
+										 ("crc16", crc16)):
+		func(frames[0])
+		t1 = time.time()
+		for i in xrange(n):
+			func(frames[i % 200])
+		t2 = time.time()
+		results.append((name, (t2 - t1) / n))
+
+	blob = string.join(['\x01' + f for f in frames], '') * (n / 200)
+	t1 = time.time()
+	ok = verify_frames(blob)
+	t2 = time.time()
+	results.append(("verify_frames", (t2 - t1) / len(ok)))
+
+	base = results[0][1]
+	for name, per in results:
+		warn("%-14s %8.2f us/frame  %6.1fx" % (name, per * 1e6, base / per))
+	return results
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help", "bench"])
+
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+		if field == "--bench":
+			bench()
+			return
+	usage(progname)
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
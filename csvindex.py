@@ -0,0 +1,182 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args] file.csv t1 [t2]
+
+	Prints the rows of a CSVUpdate file from t1 to t2, seeking to them
+	through the file.csv.idx sidecar index.  The index is only read, so
+	this is safe next to a running logger; without a usable one the file
+	is read from the start.  Times are seconds since the epoch or local
+	"YYYY-MM-DD[ HH:MM[:SS]]".
+"""
+
+
+import os, sys, string, time, getopt
+from log import *
+
+import recordfile
+
+
+## seconds of rows per index entry
+kBucket = 3600
+
+
+def rowTime(line):
+	"""the time of a CSV row that starts with year,month,day,h,m,s"""
+	f = string.split(line, ",", 6)
+	return time.mktime((int(f[0]), int(f[1]), int(f[2]), int(f[3]), int(f[4]), int(f[5]), 0, 0, -1))
+
+
+class CSVIndex:
+	"""Sidecar index of a CSV file whose rows are in time order: the byte
+	offset of the first row of every bucket seconds, kept in a RecordFile
+	next to it.  Rows appended behind our back are indexed when the index
+	is opened; a file that got shorter is indexed from scratch.
+
+	A readonly index never writes or rebuilds the file.  Rows past the
+	last one indexed are found by reading on from there, and an index
+	that is missing or does not match the file is not used at all."""
+	def __init__(self, path, bucket=kBucket, readonly=0):
+		self.path = path
+		self.bucket = bucket
+		self.readonly = readonly
+		self.lastBucket = None
+		self.end = 0						## offset of the last row indexed
+		self.open()
+
+	def open(self):
+		if self.readonly:
+			self.openReadOnly()
+			return
+
+		self.index = recordfile.RecordFile(self.path + ".idx", '<dQ', ['bucket', 'offset'])
+		n = len(self.index)
+		if n: self.lastBucket, self.end = self.index.read(n - 1)
+
+		size = 0
+		if os.path.exists(self.path): size = os.path.getsize(self.path)
+		if self.end > size:
+			self.rebuild()
+		elif self.end < size:
+			self.scan(self.end)
+
+	def openReadOnly(self):
+		self.index = None
+		try:
+			index = recordfile.RecordFile(self.path + ".idx", '<dQ', ['bucket', 'offset'], readonly=1)
+		except IOError, msg:
+			warn("not using the index:", msg)
+			return
+		n = len(index)
+		if n: self.lastBucket, self.end = index.read(n - 1)
+
+		size = 0
+		if os.path.exists(self.path): size = os.path.getsize(self.path)
+		if self.end > size:
+			warn("not using the index:", self.path, "got shorter since it was built")
+			index.close()
+			return
+		self.index = index
+
+	def close(self):
+		if self.index is not None: self.index.close()
+
+	def add(self, t, offset):
+		"""a row for time t was written at offset"""
+		b = t - t % self.bucket
+		if self.lastBucket is None or b > self.lastBucket:
+			self.index.append((b, offset))
+			self.lastBucket = b
+		self.end = offset
+
+	def scan(self, offset):
+		"""index the rows from offset to the end of the file"""
+		if not os.path.exists(self.path): return
+		fp = open(self.path, "rb")
+		fp.seek(offset)
+		for line in fp:
+			try:
+				t = rowTime(line)
+			except (ValueError, IndexError, OverflowError):
+				pass
+			else:
+				self.add(t, offset)
+			offset = offset + len(line)
+		fp.close()
+		self.index.sync()
+
+	def rebuild(self):
+		if self.readonly: raise IOError, "index of %s is open read-only" % self.path
+		self.index.close()
+		os.remove(self.path + ".idx")
+		self.lastBucket = None
+		self.end = 0
+		self.index = recordfile.RecordFile(self.path + ".idx", '<dQ', ['bucket', 'offset'])
+		self.scan(0)
+
+	def seek(self, t):
+		"""offset of the first row that can be at or after t"""
+		if self.index is None: return 0
+		i, j = self.index.indexRange(0, t)
+		if j == 0: return 0
+		return self.index.read(j - 1)[1]
+
+	def query(self, t1, t2):
+		"""(t, line) for every row from t1 to t2"""
+		fp = open(self.path, "rb")
+		try:
+			fp.seek(self.seek(t1))
+			for line in fp:
+				try:
+					t = rowTime(line)
+				except (ValueError, IndexError, OverflowError):
+					continue
+				if t < t1: continue
+				if t > t2: break
+				yield t, line
+		finally:
+			fp.close()
+
+
+def parseTime(s):
+	try:
+		return float(s)
+	except ValueError:
+		pass
+	for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+		try:
+			return time.mktime(time.strptime(s, fmt))
+		except ValueError:
+			pass
+	raise ValueError, "bad time %s" % s
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help"])
+
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+
+	if len(args) < 2:
+		usage(progname)
+		return
+
+	t1 = parseTime(args[1])
+	t2 = sys.maxint
+	if len(args) > 2: t2 = parseTime(args[2])
+
+	index = CSVIndex(args[0], readonly=1)
+	for (t, line) in index.query(t1, t2):
+		stdout.write(line)
+	index.close()
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
@@ -0,0 +1,140 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args]
+
+	The CSV sink: a row per update in config.kCSVFile.  Run on its own it
+	prints the file's last rows.
+
+	--lines=N    how many rows (default 10)
+"""
+
+
+import os, sys, string, time, getopt, collections
+from log import *
+
+import weather
+import csvindex
+
+
+class CSVUpdate(weather.Updater):
+	"""Appends a row per update to kCSVFile and keeps its last
+	kCSV_MaxLines rows.
+
+	The rows are also kept in memory.  The file is allowed to run up to
+	kCSV_Slack rows over the limit and is then rewritten from memory
+	through a temp file and a rename, so an update costs one small write
+	however long the file is.
+	"""
+	def __init__(self, config, updateInterval=10):
+		weather.Updater.__init__(self, config, updateInterval)
+		self.path = config.kCSVFile
+		self.maxLines = config.kCSV_MaxLines
+		self.slack = getattr(config, 'kCSV_Slack', None)
+		if self.slack is None and self.maxLines: self.slack = max(1, self.maxLines / 4)
+
+		self.rows = None
+		if self.maxLines: self.rows = collections.deque(maxlen=self.maxLines)
+		self.fp = None
+		self.fileRows = 0
+		self.size = 0
+		self.rewrites = 0
+		self.open()
+
+		self.index = None
+		if getattr(config, 'kCSV_Index', 0):
+			self.index = csvindex.CSVIndex(self.path, getattr(config, 'kCSV_IndexBucket', csvindex.kBucket))
+
+	def open(self):
+		"""(re)open the file for appending, taking in the rows it has"""
+		if self.fp is not None: self.fp.close()
+		self.fileRows = 0
+		if self.rows is not None: self.rows.clear()
+		if os.path.isfile(self.path):
+			fp = open(self.path)
+			for line in fp:
+				self.fileRows = self.fileRows + 1
+				if self.rows is not None: self.rows.append(line)
+			fp.close()
+		self.fp = open(self.path, "a")
+		self.fp.seek(0, 2)
+		self.size = self.fp.tell()
+
+	def compact(self):
+		"""rewrite the file with only the rows in memory"""
+		tmp = self.path + ".tmp"
+		fp = open(tmp, "w")
+		fp.writelines(self.rows)
+		fp.flush()
+		os.fsync(fp.fileno())
+		fp.close()
+		os.rename(tmp, self.path)
+		self.rewrites = self.rewrites + 1
+		self.open()
+		if self.index is not None: self.index.rebuild()
+
+	def _update(self, sensor):
+		t = time.localtime(sensor.sample_time)
+		
+		line = [t[0], t[1], t[2], t[3], t[4], t[5]]
+		line.append(sensor.wind_speed)
+		line.append(sensor.wind_gust_speed)
+		line.append(sensor.wind_direction)
+		line.append(sensor.inside_humidity)
+		line.append(sensor.outside_humidity)
+		line.append(sensor.inside_temp)
+		line.append(sensor.outside_temp)
+		line.append(sensor.barometer)
+		line.append(sensor.total_rain)
+		line.append(sensor.total_rain)
+		line.append(sensor.rain_diff)
+		line.append(sensor.basement_temp)
+		line.append(sensor.basement_humidity)
+		line.append(0)
+
+		sline = []
+		for num in line: sline.append(str(num))
+		row = string.join(sline, ",") + os.linesep
+
+		## removed or rotated by someone else
+		if not os.path.isfile(self.path): self.open()
+
+		if self.rows is not None: self.rows.append(row)
+		if self.maxLines and self.fileRows >= self.maxLines + self.slack:
+			self.compact()
+			return
+
+		offset = self.size
+		self.fp.write(row)
+		self.fp.flush()
+		self.size = self.size + len(row)
+		self.fileRows = self.fileRows + 1
+		if self.index is not None: self.index.add(sensor.sample_time, offset)
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help", "lines="])
+
+	lines = 10
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+		elif field == "--lines":
+			lines = int(val)
+
+	path = weather.config.kCSVFile
+	if not path or not os.path.isfile(path):
+		warn("no CSV file", path)
+		return
+	for line in collections.deque(open(path), lines):
+		stdout.write(line)
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
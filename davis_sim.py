@@ -0,0 +1,510 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args]
+
+	Davis Monitor II console simulator on a pseudo-terminal.  Prints the
+	slave device to use as kCommPort and answers WRD, WWR, RRD, SRD,
+	START and LOOP like the console and its WeatherLink do.
+
+	--baud=N       emulated line speed (default 2400, 0 = unlimited)
+	--speed=X      run the LOOP cadence and latency X times faster
+	--drift=R      console clock drift in seconds per second
+	--noise=P      probability that a sent byte gets a bit flipped
+	--drop=P       probability that a sent byte is lost
+	--latency=S    extra delay before each response, in seconds
+	--run          run the station against the simulator, restarted
+	               after errors as weather.main() does
+	--duration=S   with --run, stop after S seconds and print the stats
+	--poll         with --run, send a LOOP per sample instead of streaming
+	--test         run the self tests against the simulator
+"""
+
+
+import os, sys, string, time, getopt, struct, random, select
+from log import *
+
+import crc16
+import serial
+import station_davis
+from weather_util import toBCD
+
+ACK = chr(6)
+
+## seconds between LOOP packets on a Monitor II
+kLoopInterval = 2.0
+
+## archive interval in seconds and records present at startup
+kArchivePeriod = 600
+kArchiveFill = 6 * 24
+
+
+class Console:
+	"""The console's memory, clock, sensors and archive."""
+	def __init__(self, drift=0.0):
+		self.drift = drift
+		self.epoch = time.time()
+		self.clock_offset = 0
+
+		self.banks = {0: [0] * 256, 1: [0] * 256}
+		self.poke(0, 0x4D, 1, chr(2))				## Monitor II
+		self.pokeWord(1, 0x52, 0)						## inside temp cal
+		self.pokeWord(1, 0x78, 0)						## outside temp cal
+		self.pokeWord(1, 0xD6, 100)					## rain clicks per inch
+		self.pokeWord(1, 0xDA, 0)						## outside humidity cal
+		self.pokeWord(1, 0x2C, 0)						## barometer cal
+
+		self.inside_temp = 705
+		self.outside_temp = 512
+		self.wind = 4
+		self.wind_dir = 225
+		self.barometer = 29530 - 370
+		self.inside_hum = 41
+		self.outside_hum = 63
+		self.rain = 120
+
+		self.sram = bytearray(station_davis.kArchiveSize)
+		self.archive_new = 0
+		self.archive_old = 0
+		self.last_archive = 0
+		self.fillArchive(kArchiveFill)
+
+	def now(self):
+		"""console time: the host clock plus an offset and a drift rate"""
+		t = time.time()
+		return t + (t - self.epoch) * self.drift + self.clock_offset
+
+	## -- nibble memory
+
+	def poke(self, bank, addr, n, data):
+		for i in range(n):
+			c = ord(data[i >> 1])
+			if i & 1: c = c >> 4
+			self.banks[bank][(addr + i) & 0xff] = c & 0x0f
+
+	def peek(self, bank, addr, n):
+		mem = self.banks[bank]
+		ret = []
+		for i in range(0, n, 2):
+			c = mem[(addr + i) & 0xff]
+			if i + 1 < n: c = c | (mem[(addr + i + 1) & 0xff] << 4)
+			ret.append(chr(c))
+		return string.join(ret, '')
+
+	def pokeWord(self, bank, addr, n):
+		self.poke(bank, addr, 4, struct.pack('<h', n))
+
+	def syncClock(self):
+		"""copy the clock into its memory registers"""
+		lt = time.localtime(self.now())
+		self.poke(1, 0xBE, 6, chr(toBCD(lt[3])) + chr(toBCD(lt[4])) + chr(toBCD(lt[5])))
+		self.poke(1, 0xC8, 3, chr(toBCD(lt[2])) + chr(lt[1]))
+
+	def clockWritten(self):
+		"""a WWR touched the clock registers: adopt the new time"""
+		from weather_util import fromBCD
+		d = self.peek(1, 0xBE, 6)
+		hour, min, sec = fromBCD(ord(d[0])), fromBCD(ord(d[1])), fromBCD(ord(d[2]))
+		d = self.peek(1, 0xC8, 3)
+		day, month = fromBCD(ord(d[0])), ord(d[1]) & 0x0f
+		lt = time.localtime(self.now())
+		t = time.mktime((lt[0], month or lt[1], day or lt[2], hour, min, sec, 0, 0, -1))
+		self.clock_offset = self.clock_offset + (t - self.now())
+
+	## -- sensors
+
+	def step(self):
+		self.outside_temp = self.outside_temp + random.randint(-2, 2)
+		self.wind = max(0, min(60, self.wind + random.randint(-2, 2)))
+		self.wind_dir = (self.wind_dir + random.randint(-10, 10)) % 360
+		self.barometer = self.barometer + random.randint(-1, 1)
+		self.outside_hum = max(5, min(100, self.outside_hum + random.randint(-1, 1)))
+		if random.random() < 0.05: self.rain = (self.rain + 1) & 0x7fff
+
+	def loopPacket(self):
+		self.step()
+		payload = struct.pack('<hhBhhBBhh', self.inside_temp, self.outside_temp,
+													self.wind, self.wind_dir, self.barometer,
+													self.inside_hum, self.outside_hum, self.rain, 0)
+		return crc16.make_frame(payload)
+
+	## -- archive
+
+	def archiveRecord(self, t):
+		lt = time.localtime(t)
+		return station_davis.archive_struct.pack(
+			self.barometer + 370, self.inside_hum, self.outside_hum, 0,
+			self.inside_temp, self.outside_temp, self.wind, self.wind_dir * 16 / 360,
+			self.outside_temp + 5, self.wind + 3,
+			toBCD(lt[2]), toBCD(lt[1]), toBCD(lt[3]), toBCD(lt[4]),
+			self.outside_temp - 5)
+
+	def addArchive(self, t):
+		size = station_davis.kArchiveRecordSize
+		n = station_davis.kArchiveRecords
+		a = self.archive_new
+		self.sram[a:a+size] = self.archiveRecord(t)
+		self.archive_new = (a + size) % (n * size)
+		if self.archive_new == self.archive_old:
+			self.archive_old = (self.archive_old + size) % (n * size)
+		self.last_archive = t
+
+	def fillArchive(self, count):
+		t = self.now()
+		t = t - t % kArchivePeriod - count * kArchivePeriod
+		for i in range(count):
+			t = t + kArchivePeriod
+			self.step()
+			self.addArchive(t)
+
+	def archiveTick(self):
+		t = self.now()
+		while t - self.last_archive >= kArchivePeriod:
+			self.addArchive(self.last_archive + kArchivePeriod)
+
+	def readLink(self, addr, n):
+		mem = {station_davis.kArchiveNewPtr: struct.pack('<H', self.archive_new),
+					 station_davis.kArchiveOldPtr: struct.pack('<H', self.archive_old)}
+		return mem.get(addr, '\0\0')[:(n+1)/2]
+
+	def readSRAM(self, addr, n):
+		data = str(self.sram[addr:addr+n])
+		crc = crc16.crc16(data)
+		return data + chr(crc >> 8) + chr(crc & 0xff)
+
+
+class Simulator:
+	"""Serves a Console on the master side of a pty."""
+	def __init__(self, console=None, baud=2400, speed=1.0, noise=0.0, drop=0.0, latency=0.0):
+		if console is None: console = Console()
+		self.console = console
+		self.baud = baud
+		self.speed = speed
+		self.noise = noise
+		self.drop = drop
+		self.latency = latency
+
+		self.master, self.slave = os.openpty()
+		self.path = os.ttyname(self.slave)
+
+		self.inbuf = ''
+		self.looping = 0
+		self.next_loop = 0
+		self.running = 0
+		self.deaf = 0							## commands still to ignore
+
+		self.stats = {'commands': 0, 'loop_packets': 0, 'bytes_out': 0,
+									'bytes_in': 0, 'corrupted': 0, 'dropped': 0, 'bad_commands': 0,
+									'ignored': 0}
+
+	## -- line emulation
+
+	def send(self, data):
+		if self.latency: time.sleep(self.latency / self.speed)
+
+		out = []
+		for c in data:
+			if self.drop and random.random() < self.drop:
+				self.stats['dropped'] = self.stats['dropped'] + 1
+				continue
+			if self.noise and random.random() < self.noise:
+				c = chr(ord(c) ^ (1 << random.randrange(8)))
+				self.stats['corrupted'] = self.stats['corrupted'] + 1
+			out.append(c)
+		out = string.join(out, '')
+
+		if self.baud:
+			time.sleep(len(data) * 10. / self.baud)
+		os.write(self.master, out)
+		self.stats['bytes_out'] = self.stats['bytes_out'] + len(out)
+
+	## -- command parser
+
+	def command(self):
+		"""Take one complete command off the input buffer and answer it.
+		Returns false when more input is needed."""
+		buf = self.inbuf
+		c = self.console
+
+		if buf[:3] == "WRD":
+			if len(buf) < 6: return 0
+			n = ord(buf[3]) >> 4
+			bank = (ord(buf[3]) & 0x0f == 4)
+			addr = ord(buf[4])
+			if bank == 1: c.syncClock()
+			self.inbuf = buf[6:]
+			self.send(ACK + c.peek(bank, addr, n))
+		elif buf[:3] == "WWR":
+			if len(buf) < 5: return 0
+			n = ord(buf[3]) >> 4
+			size = 6 + (n + 1) / 2
+			if len(buf) < size: return 0
+			bank = (ord(buf[3]) & 0x0f == 3)
+			addr = ord(buf[4])
+			if bank == 1: c.syncClock()
+			c.poke(bank, addr, n, buf[5:size-1])
+			if bank == 1 and addr < 0xCB and addr + n > 0xBE: c.clockWritten()
+			self.inbuf = buf[size:]
+			self.send(ACK)
+		elif buf[:3] == "RRD":
+			if len(buf) < 7: return 0
+			addr = ord(buf[4])
+			n = ord(buf[5]) + 1
+			self.inbuf = buf[7:]
+			self.send(ACK + c.readLink(addr, n))
+		elif buf[:3] == "SRD":
+			if len(buf) < 7: return 0
+			addr = ord(buf[3]) | (ord(buf[4]) << 8)
+			n = ord(buf[5]) + 1
+			self.inbuf = buf[7:]
+			c.archiveTick()
+			self.send(ACK + c.readSRAM(addr, n))
+		elif buf[:5] == "START":
+			if len(buf) < 6: return 0
+			self.inbuf = buf[6:]
+			self.send(ACK)
+		elif buf[:4] == "LOOP":
+			if len(buf) < 7: return 0
+			n = ord(buf[4]) | (ord(buf[5]) << 8)
+			self.inbuf = buf[7:]
+			self.send(ACK)
+			self.looping = (65536 - n) & 0xffff
+			self.next_loop = time.time()
+		else:
+			if not buf: return 0
+			## resync on the next thing that looks like a command
+			self.stats['bad_commands'] = self.stats['bad_commands'] + 1
+			self.inbuf = buf[1:]
+			return 1
+
+		self.stats['commands'] = self.stats['commands'] + 1
+		return 1
+
+	def serve(self):
+		self.running = 1
+		while self.running:
+			timeout = 0.5
+			if self.looping:
+				timeout = max(0, self.next_loop - time.time())
+
+			r, w, x = select.select([self.master], [], [], timeout)
+			if r:
+				data = os.read(self.master, 1024)
+				self.stats['bytes_in'] = self.stats['bytes_in'] + len(data)
+				if self.deaf:
+					## never heard: the host times out waiting for the ACK
+					self.deaf = self.deaf - 1
+					self.stats['ignored'] = self.stats['ignored'] + 1
+					continue
+				## any input stops a running LOOP, as on the console
+				self.looping = 0
+				self.inbuf = self.inbuf + data
+				while self.command(): pass
+
+			if self.looping and time.time() >= self.next_loop:
+				self.send(self.console.loopPacket())
+				self.stats['loop_packets'] = self.stats['loop_packets'] + 1
+				self.looping = self.looping - 1
+				self.next_loop = self.next_loop + kLoopInterval / self.speed
+
+	def start(self):
+		import thread
+		thread.start_new_thread(self.serve, ())
+		return self.path
+
+	def stop(self):
+		self.running = 0
+
+	def report(self, elapsed):
+		keys = self.stats.keys()
+		keys.sort()
+		l = []
+		for k in keys: l.append("%s=%s" % (k, self.stats[k]))
+		warn("simulator after %.1fs:" % elapsed, string.join(l, " "))
+		if elapsed:
+			warn("  %.2f LOOP packets/s, %.1f bytes/s out" % (
+				self.stats['loop_packets'] / elapsed, self.stats['bytes_out'] / elapsed))
+
+
+
+def run(sim, duration=0, poll=0):
+	"""Point the configured station at the simulator and run it through
+	weather.restart(), as weather.main() does, so dropped and corrupted
+	bytes are recovered from the same way."""
+	import weather, thread
+
+	config = weather.config
+	config.kCommPort = sim.path
+	config.kStationType = weather.kStation_Davis
+	config.kUpdateInterval = max(1, config.kUpdateInterval / sim.speed)
+	if poll: config.kLoopStream = 0
+
+	t1 = time.time()
+	if duration:
+		def stopper():
+			time.sleep(duration)
+			thread.interrupt_main()
+		thread.start_new_thread(stopper, ())
+
+	loop = weather.StationLoop(upload=0)
+	try:
+		weather.restart(loop.run)
+	except KeyboardInterrupt:
+		pass
+	sim.report(time.time() - t1)
+
+	wl = loop.logger
+	if wl is not None:
+		warn("station: handshakes=%d resumes=%d restarts=%d samples=%d" % (
+			wl.handshakes, wl.resumed, max(0, loop.runs - 1), len(wl.samples)))
+
+
+## -- self tests, run with --test
+
+class TestConfig:
+	kUpdateInterval = 1
+	kLoopStream = 0
+	def __init__(self, path, **kw):
+		self.kCommPort = path
+		for (k, v) in kw.items(): setattr(self, k, v)
+
+def openPort(sim, **kw):
+	config = TestConfig(sim.path, **kw)
+	port = serial.open(station_davis.GetSerialConfig(config))
+	port.cfg['timeOutMs'] = 500
+	return config, port
+
+def closeSim(sim, port):
+	sim.stop()
+	port.close()
+	os.close(sim.master)
+	os.close(sim.slave)
+
+def testReadLatest():
+	"""frames that all arrive in one read: readLatest() returns the newest"""
+	sim = Simulator(baud=0)
+	config, port = openPort(sim)
+	try:
+		dl = station_davis.DataLogger(None, port)
+		stream = station_davis.LoopStream(dl, 15)
+		stream.remaining = 15
+		frames = []
+		for i in range(15):
+			sim.console.inside_temp = 700 + i
+			frames.append(sim.console.loopPacket())
+		os.write(sim.master, string.join(frames, ''))
+
+		frame = stream.readLatest()
+		got = station_davis.loop_struct.unpack_from(frame)[0]
+		assert got == 714, "got frame %d of 15" % (got - 700)
+		assert stream.frames == 15, "%d frames decoded" % stream.frames
+	finally:
+		closeSim(sim, port)
+
+class StopAfter:
+	"""A sink that has the simulator ignore one command after the first
+	sample and stops the run with KeyboardInterrupt after n samples."""
+	def __init__(self, sim, n):
+		self.sim = sim
+		self.n = n
+		self.samples = 0
+
+	def update(self, si):
+		self.samples = self.samples + 1
+		if self.samples == 1: self.sim.deaf = 1
+		if self.samples >= self.n: raise KeyboardInterrupt
+
+	def backfill(self, si):
+		pass
+
+def testResume():
+	"""a timeout while polling: StartLoop() resumes without a handshake"""
+	import weather
+	sim = Simulator(baud=0)
+	sim.start()
+	config, port = openPort(sim)
+	try:
+		dl = station_davis.DataLogger(config, port)
+		stop = StopAfter(sim, 3)
+		dl.SetUpdater(stop)
+		try:
+			weather.StationLoop(0, dl).run()
+		except KeyboardInterrupt:
+			pass
+		assert sim.stats['ignored'] == 1, "no command was ignored"
+		assert stop.samples == 3, "stopped after %d samples" % stop.samples
+		assert dl.handshakes == 1, "%d handshakes" % dl.handshakes
+		assert dl.resumed >= 1, "never resumed"
+	finally:
+		closeSim(sim, port)
+
+kTests = [testReadLatest, testResume]
+
+def test():
+	"""Run kTests; returns the number that failed."""
+	failed = 0
+	for t in kTests:
+		try:
+			t()
+			warn("ok  ", t.__name__)
+		except AssertionError, msg:
+			failed = failed + 1
+			warn("FAIL", t.__name__, msg)
+		except:
+			failed = failed + 1
+			import traceback
+			traceback.print_exc()
+			warn("FAIL", t.__name__)
+	return failed
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help", "baud=", "speed=", "noise=",
+																						"drop=", "latency=", "drift=", "run", "duration=", "poll",
+																						"test"])
+
+	kw = {}
+	drift = 0.0
+	dorun = 0
+	duration = 0
+	poll = 0
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+		elif field == "--baud": kw['baud'] = int(val)
+		elif field == "--speed": kw['speed'] = float(val)
+		elif field == "--drift": drift = float(val)
+		elif field == "--noise": kw['noise'] = float(val)
+		elif field == "--drop": kw['drop'] = float(val)
+		elif field == "--latency": kw['latency'] = float(val)
+		elif field == "--run": dorun = 1
+		elif field == "--duration": duration = float(val)
+		elif field == "--poll": poll = 1
+		elif field == "--test":
+			if test(): sys.exit(1)
+			return
+
+	sim = Simulator(Console(drift), **kw)
+	path = sim.start()
+	warn("Davis simulator on", path)
+
+	if dorun:
+		run(sim, duration, poll)
+		return
+
+	t1 = time.time()
+	try:
+		while 1:
+			time.sleep(60)
+			sim.report(time.time() - t1)
+	except KeyboardInterrupt:
+		sim.report(time.time() - t1)
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
@@ -462,6 +462,206 @@ class aHTTP:
 				self.sock = None
 
 
+HTTP11_VERSION = 'HTTP/1.1'
+
+class KeepAliveHTTP:
+		"""
+			An HTTP/1.1 connection that stays open between requests.
+
+			request() only queues a request and flush() writes everything
+			queued in one send, so several requests can be pipelined;
+			getreply() reads the replies back in the order they were asked
+			for.  When the server has closed the connection it is reopened
+			and the requests still waiting for a reply are sent again, so
+			only queue requests that can safely be repeated.  A timeout is
+			raised as socket.timeout and nothing is resent.
+		"""
+
+		def __init__(self, host, port = 0, timeout = 10):
+				if not port:
+						i = string.find(host, ':')
+						if i >= 0:
+								host, port = host[:i], host[i+1:]
+								try: port = string.atoi(port)
+								except string.atoi_error:
+										raise socket.error, "nonnumeric port"
+						else:
+								port = HTTP_PORT
+				self.host = host
+				self.port = port
+				self.hostHeader = host
+				if port != HTTP_PORT: self.hostHeader = "%s:%d" % (host, port)
+				self.timeout = timeout
+				self.debuglevel = 0
+
+				self.sock = None
+				self.rfile = None
+				self.file = None
+				self.headers = None
+				self.pending = []			# requests waiting for a reply, oldest first
+				self.sent = 0					# how many of them have been written
+				self.answered = 0			# replies read on this connection
+
+				self.connects = 0
+				self.requests = 0
+				self.resent = 0
+
+		def set_debuglevel(self, debuglevel):
+				self.debuglevel = debuglevel
+
+		def connect(self):
+				self.close()
+				try:
+					host_ip = fhttplib.ip_cache[self.host]
+				except KeyError:
+					host_ip = socket.gethostbyname(self.host)
+					fhttplib.ip_cache[self.host] = host_ip
+
+				if self.debuglevel > 0: log ('connect:', (self.host, self.port))
+				sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				sock.settimeout(self.timeout)
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+				try:
+					sock.connect((host_ip, self.port))
+				except:
+					sock.close()
+					raise
+				self.sock = sock
+				self.rfile = sock.makefile('rb')
+				self.connects = self.connects + 1
+				self.answered = 0
+
+		def request(self, method, selector, headers = ()):
+				"""Queue a request; headers are (name, value) pairs."""
+				if not selector: selector = '/'
+				lines = ['%s %s %s\r\n' % (method, selector, HTTP11_VERSION),
+								 'Host: %s\r\n' % self.hostHeader]
+				for (header, value) in headers:
+						lines.append('%s: %s\r\n' % (header, value))
+				lines.append('\r\n')
+				self.pending.append(string.join(lines, ''))
+				self.requests = self.requests + 1
+
+		def flush(self):
+				"""Write the queued requests that have not been sent yet."""
+				if self.sent == len(self.pending): return
+				retry = self.sock is not None
+				if self.sock is None: self.connect()
+				data = string.join(self.pending[self.sent:], '')
+				if self.debuglevel > 0: log ('send:', `data`)
+				try:
+					self.sock.sendall(data)
+				except socket.timeout:
+					self.close()
+					raise
+				except socket.error:
+					## the server closed a connection we had kept
+					if not retry: raise
+					self.reconnect()
+					return
+				self.sent = len(self.pending)
+
+		def reconnect(self):
+				"""Open a new connection and send every request still waiting."""
+				self.connect()
+				self.resent = self.resent + self.sent
+				self.sent = 0
+				data = string.join(self.pending, '')
+				self.sock.sendall(data)
+				self.sent = len(self.pending)
+
+		def getreply(self):
+				"""Read the reply to the oldest request.  Returns the same as
+				HTTP.getreply(); the body is in getfile()."""
+				if not self.pending: raise socket.error, "no request pending"
+				self.flush()
+				try:
+					reply = self._readreply()
+				except socket.timeout:
+					self.close()
+					raise
+				except socket.error:
+					reply = None
+				if reply is None:
+					## closed before the first reply on a fresh connection is
+					## the server's doing, not a stale connection
+					if not self.answered:
+						self.close()
+						raise socket.error, "connection closed by server"
+					self.reconnect()
+					reply = self._readreply()
+					if reply is None:
+						self.close()
+						raise socket.error, "connection closed by server"
+
+				del self.pending[0]
+				self.sent = self.sent - 1
+				self.answered = self.answered + 1
+
+				errcode, errmsg, self.headers, body, keep = reply
+				self.file = cStringIO.StringIO(body)
+				if not keep: self.close()
+				return errcode, errmsg, self.headers
+
+		def _readreply(self):
+				"""(errcode, errmsg, headers, body, keepalive), or None if the
+				connection was closed before a status line arrived"""
+				rfile = self.rfile
+				line = rfile.readline()
+				if not line: return None
+				if self.debuglevel > 0: log ('reply:', line)
+				try:
+						[ver, code, msg] = string.split(line, None, 2)
+				except ValueError:
+						[ver, code] = string.split(line, None, 1)
+						msg = ""
+				if ver[:5] != 'HTTP/':
+						raise socket.error, "bad status line %s" % repr(line)
+				errcode = string.atoi(code)
+				headers = mimetools.Message(rfile, 0)
+
+				keep = ver == HTTP11_VERSION
+				conn = string.lower(headers.getheader('connection') or '')
+				if conn == 'close': keep = 0
+				elif conn == 'keep-alive': keep = 1
+
+				if string.lower(headers.getheader('transfer-encoding') or '') == 'chunked':
+						chunks = []
+						while 1:
+								size = string.atoi(string.split(rfile.readline(), ';')[0], 16)
+								if not size: break
+								chunks.append(rfile.read(size))
+								rfile.readline()
+						## trailers
+						while string.strip(rfile.readline()): pass
+						body = string.join(chunks, '')
+				elif headers.getheader('content-length') is not None:
+						body = rfile.read(string.atoi(headers.getheader('content-length')))
+				else:
+						body = rfile.read()
+						keep = 0
+				return errcode, string.strip(msg), headers, body, keep
+
+		def getfile(self):
+				return self.file
+
+		def reset(self):
+				"""Close the connection and forget every queued request."""
+				self.close()
+				self.pending = []
+
+		def close(self):
+				"""Close the connection; queued requests are kept and sent
+				again on the next one."""
+				if self.rfile:
+						self.rfile.close()
+				self.rfile = None
+				if self.sock:
+						self.sock.close()
+				self.sock = None
+				self.sent = 0
+
+
 def test():
 		"""Test this module.
 
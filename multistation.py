@@ -0,0 +1,268 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args]
+
+	Runs several Davis consoles from one process.  Every station in
+	config.kStations streams LOOP packets and all of their ports, serial
+	or tcp, are multiplexed in a single select() loop.
+"""
+
+
+import os, sys, string, time, getopt, select
+from log import *
+
+import serial
+import weather
+import station_davis
+
+
+## seconds without a frame before a station is restarted
+kStationTimeout = 30
+
+## seconds to wait before retrying a station that failed to restart
+kStationRetry = 60
+
+## seconds between per-station stats in the log
+kStatsInterval = 600
+
+## seconds of archive read back when a station restarts, which holds up
+## the other stations while it runs
+kRestartCatchup = 15 * 60
+
+
+class StationConfig:
+	"""The global config with per-station overrides on top."""
+	def __init__(self, config, overrides):
+		self._config = config
+		self._overrides = overrides
+
+	def __getattr__(self, name):
+		try:
+			return self._overrides[name]
+		except KeyError:
+			return getattr(self._config, name)
+
+
+class Station:
+	def __init__(self, name, config):
+		self.name = name
+		self.config = config
+
+		self.port = None
+		self.logger = None
+		self.stream = None
+
+		self.frames = 0
+		self.samples = 0
+		self.restarts = 0
+		self.lastFrame = 0
+		self.lastSample = 0
+		self.retryAt = 0
+
+		self.latency_n = 0
+		self.latency_sum = 0.0
+		self.latency_max = 0.0
+		self.latency_last = 0.0
+
+	def open(self, upload=1):
+		cfg = station_davis.GetSerialConfig(self.config)
+		self.port = serial.open(cfg)
+		self.logger = station_davis.DataLogger(self.config, self.port)
+
+		weather.AddSinks(self.logger, self.config, upload)
+
+	def reopen(self):
+		"""Close the port and open it again, for a dropped connection."""
+		self.logger.Reopen()
+		self.port = self.logger.port
+
+	def start(self, catchup=None):
+		"""(Re)start LOOP streaming, with a full handshake if needed.
+		catchup limits the seconds of archive read back."""
+		dl = self.logger
+		if not dl.session:
+			if not dl.Handshake():
+				raise serial.TimeoutError, "station %s did not answer" % self.name
+		else:
+			self.port.flush()
+		dl.CatchUpArchive(catchup)
+		self.stream = station_davis.LoopStream(dl, getattr(self.config, 'kLoopStreamCount', station_davis.kLoopStreamCount))
+		self.stream.start()
+		self.lastFrame = time.time()
+
+	def fileno(self):
+		return self.port.fileno()
+
+	def readable(self, ready):
+		"""Data is waiting: take in every frame and process a sample when
+		one is due.  ready is when select() returned."""
+		stream = self.stream
+		## readable with nothing to read: the other end has closed
+		if not stream.fill(): raise weather.CommError, "port closed"
+		n = 0
+		while 1:
+			while stream.nextFrame(): n = n + 1
+			if not stream.fill(): break
+		if not n: return
+
+		now = time.time()
+		self.frames = self.frames + n
+		self.lastFrame = now
+		if stream.remaining <= 0: stream.start()
+
+		if now - self.lastSample < self.config.kUpdateInterval: return
+
+		dl = self.logger
+		si = dl.DecodeLOOP(stream.frame)
+		dl.ProcessSample(si, now)
+		dl.resumes = 0
+		self.lastSample = now
+		self.samples = self.samples + 1
+
+		lat = time.time() - ready
+		self.latency_last = lat
+		self.latency_n = self.latency_n + 1
+		self.latency_sum = self.latency_sum + lat
+		if lat > self.latency_max: self.latency_max = lat
+
+	def stats(self):
+		mean = 0.0
+		if self.latency_n: mean = self.latency_sum / self.latency_n
+		resyncs = 0
+		if self.stream: resyncs = self.stream.resyncs
+		updaters = {}
+		if self.logger: updaters = self.logger.UpdaterStats()
+		return {'frames': self.frames, 'samples': self.samples,
+						'restarts': self.restarts, 'resyncs': resyncs,
+						'latency': self.latency_last, 'mean_latency': mean,
+						'max_latency': self.latency_max, 'updaters': updaters}
+
+
+class MultiStationLoop:
+	def __init__(self, config, upload=1):
+		self.config = config
+		self.upload = upload
+		self.stations = []
+
+		i = 0
+		for overrides in config.kStations:
+			i = i + 1
+			name = overrides.get('name', "station%d" % i)
+			o = {}
+			for (k, v) in overrides.items():
+				if k == 'port': k = 'kCommPort'
+				o[k] = v
+			## one sample store, rollup store, rain state and upload spool per station
+			for key in ('kSampleStore', 'kRollupStore', 'kRainState', 'kWunderground_Spool'):
+				path = getattr(config, key, None)
+				if path and not o.has_key(key):
+					o[key] = "%s.%s" % (path, name)
+			self.stations.append(Station(name, StationConfig(config, o)))
+
+	def restart(self, st, msg):
+		"""Reopen a station's port and restart it.  This blocks the loop,
+		for the handshake (bounded by the port timeouts) and at most
+		kRestartCatchup seconds of archive; the other stations' consoles
+		keep buffering meanwhile."""
+		warn("station", st.name, "restarting:", msg)
+		st.restarts = st.restarts + 1
+		dl = st.logger
+		dl.resumes = dl.resumes + 1
+		if dl.resumes >= getattr(st.config, 'kResumeAttempts', station_davis.kResumeAttempts):
+			dl.session = 0
+			dl.resumes = 0
+		try:
+			st.reopen()
+			st.start(getattr(st.config, 'kRestartCatchup', kRestartCatchup))
+		except:
+			import traceback
+			traceback.print_exc()
+			st.stream = None
+			st.retryAt = time.time() + kStationRetry
+
+	def run(self):
+		for st in self.stations:
+			st.open(self.upload)
+			try:
+				st.start()
+			except:
+				import traceback
+				traceback.print_exc()
+				st.stream = None
+
+		timeout = getattr(self.config, 'kStationTimeout', kStationTimeout)
+		lastStats = time.time()
+
+		while 1:
+			live = []
+			for st in self.stations:
+				if st.stream is not None: live.append(st)
+
+			if live:
+				r, w, x = select.select(live, [], [], 1.0)
+			else:
+				r = []
+				weather.time_sleep(1.0)
+			ready = time.time()
+
+			for st in r:
+				try:
+					st.readable(ready)
+				except:
+					import traceback
+					traceback.print_exc()
+					self.restart(st, "read error")
+
+			now = time.time()
+			for st in self.stations:
+				if st.stream is None and now < st.retryAt: continue
+				if st.stream is None or now - st.lastFrame > timeout:
+					if st.lastFrame:
+						self.restart(st, "no data for %ds" % (now - st.lastFrame))
+					else:
+						self.restart(st, "no data since start")
+
+			if now - lastStats > kStatsInterval:
+				lastStats = now
+				for st in self.stations:
+					log("station", st.name, st.stats())
+
+	def stats(self):
+		ret = {}
+		for st in self.stations:
+			ret[st.name] = st.stats()
+		return ret
+
+	def close(self):
+		for st in self.stations:
+			if st.port: st.port.close()
+
+
+def run(config, upload=1):
+	ml = MultiStationLoop(config, upload)
+	try:
+		ml.run()
+	finally:
+		ml.close()
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help"])
+
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+
+	debugfull()
+	run(weather.config)
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
@@ -0,0 +1,224 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args] statefile
+
+	Rain accumulation from the console's rain counter.  Prints the totals
+	kept in a RainAccumulator state file.
+"""
+
+
+import os, sys, string, time, getopt, collections, json
+from log import *
+
+
+## seconds of rain used for the rain rate
+kRateWindow = 15 * 60
+
+## seconds of rain in rain_diff
+kDiffWindow = 3600
+
+## seconds of rain in rain_24h
+kDayWindow = 24 * 3600
+
+## seconds between writes of the state file while it is raining
+kSaveInterval = 60
+
+## a drop in the counter smaller than this is rounding, not a reset
+kEpsilon = 0.001
+
+## SensorImage fields set by RainAccumulator.add(); rain_today is
+## rain_day under the name the old since-midnight aggregate had
+kFields = ['rain_diff', 'rain_rate', 'rain_24h', 'rain_hour', 'rain_day', 'rain_today',
+					 'rain_month', 'rain_year']
+
+## (name, how many localtime() fields make up its key)
+kPeriods = [('hour', 4), ('day', 3), ('month', 2), ('year', 1)]
+
+
+class RunningDelta:
+	"""Rain over the last window seconds: the accumulated total now minus
+	the total at the oldest reading in the window.  Only readings that
+	change the total are kept, which gives the same answer, so a long
+	window stays small while it is dry."""
+	def __init__(self, window):
+		self.window = window
+		self.items = collections.deque()
+
+	def add(self, t, total):
+		items = self.items
+		if not items or items[-1][1] != total: items.append((t, total))
+		t1 = t - self.window
+		while len(items) > 1 and items[1][0] <= t1: items.popleft()
+		return total - items[0][1]
+
+
+class RainAccumulator:
+	"""Turns the console rain total into rain that actually fell.
+
+	The counter can wrap (wrap is its range in inches, 65536 clicks over
+	the rain calibration) or be reset on the console.  A drop is taken for
+	a wrap when going round would mean less than a quarter of the range
+	fell, otherwise for a reset.  Rain is added to a
+	running total and to the hour, day, month and year totals of the
+	sample's local time, all in O(1) per sample.
+
+	With a path the state is saved there as JSON, so totals survive a
+	restart and the rain that fell while we were down is counted from
+	the first reading after it.
+	"""
+	def __init__(self, path=None, wrap=None, saveInterval=kSaveInterval, diffWindow=kDiffWindow):
+		self.path = path
+		self.wrap = wrap
+		self.saveInterval = saveInterval
+
+		self.last = None						## last counter reading, in inches
+		self.lastTime = None
+		self.total = 0.0						## all rain counted
+		self.totals = {}
+		self.keys = {}
+		for (name, n) in kPeriods:
+			self.totals[name] = 0.0
+			self.keys[name] = None
+		self.wraps = 0
+		self.resets = 0
+
+		self.rate = RunningDelta(kRateWindow)
+		self.diff = RunningDelta(diffWindow)
+		self.day = RunningDelta(kDayWindow)
+		self.rainRate = 0.0
+		self.rainDiff = 0.0
+		self.rain24h = 0.0
+
+		self.dirty = 0
+		self.lastSave = 0
+		if path: self.load()
+
+	def delta(self, counter):
+		"""rain since the last reading"""
+		if self.last is None: return 0.0
+		d = counter - self.last
+		if d >= -kEpsilon: return max(0.0, d)
+		if self.wrap and d + self.wrap < self.wrap / 4:
+			self.wraps = self.wraps + 1
+			return d + self.wrap
+		## reset on the console: count what fell since
+		self.resets = self.resets + 1
+		return max(0.0, counter)
+
+	def add(self, t, si):
+		"""Count a sample and set its kFields.  Samples older than the last
+		one counted, such as stored ones reloaded after a restart, are left
+		alone: the totals now are not what they were then.  Returns the
+		rain counted for the sample."""
+		d = 0.0
+		counter = si.total_rain
+		if counter is not None and (self.lastTime is None or t > self.lastTime):
+			## a signed counter reads negative past half its range
+			if self.wrap: counter = counter % self.wrap
+			d = self.delta(counter)
+			self.last = counter
+			self.lastTime = t
+			self.total = self.total + d
+
+			lt = time.localtime(t)
+			for (name, n) in kPeriods:
+				key = list(lt[:n])
+				if key != self.keys[name]:
+					self.keys[name] = key
+					self.totals[name] = 0.0
+					self.dirty = 1
+				self.totals[name] = self.totals[name] + d
+			if d: self.dirty = 1
+
+			self.rainRate = self.rate.add(t, self.total) * 3600. / kRateWindow
+			self.rainDiff = self.diff.add(t, self.total)
+			self.rain24h = self.day.add(t, self.total)
+
+			if self.path and self.dirty and t - self.lastSave >= self.saveInterval:
+				self.save()
+				self.lastSave = t
+
+		if self.lastTime is None or t < self.lastTime: return d
+		si.rain_diff = self.rainDiff
+		si.rain_rate = self.rainRate
+		si.rain_24h = self.rain24h
+		si.rain_hour = self.totals['hour']
+		si.rain_day = self.totals['day']
+		si.rain_today = self.totals['day']
+		si.rain_month = self.totals['month']
+		si.rain_year = self.totals['year']
+		return d
+
+	def state(self):
+		return {'last': self.last, 'lastTime': self.lastTime, 'total': self.total,
+						'totals': self.totals, 'keys': self.keys,
+						'wraps': self.wraps, 'resets': self.resets,
+						'day': list(self.day.items)}
+
+	def save(self):
+		tmp = self.path + ".tmp"
+		fp = open(tmp, "w")
+		json.dump(self.state(), fp)
+		fp.flush()
+		os.fsync(fp.fileno())
+		fp.close()
+		os.rename(tmp, self.path)
+		self.dirty = 0
+
+	def load(self):
+		if not os.path.exists(self.path): return
+		try:
+			fp = open(self.path)
+			state = json.load(fp)
+			fp.close()
+		except (IOError, ValueError), e:
+			warn("rain state", self.path, "unreadable:", e)
+			return
+		self.last = state['last']
+		self.lastTime = state['lastTime']
+		self.total = state['total']
+		self.wraps = state.get('wraps', 0)
+		self.resets = state.get('resets', 0)
+		for (name, n) in kPeriods:
+			self.totals[name] = state['totals'][name]
+			self.keys[name] = state['keys'][name]
+		## the 24 hour window is saved, so rain_24h is right straight
+		## after a restart
+		for (t, total) in state.get('day', []):
+			self.day.add(t, total)
+		if self.lastTime is not None:
+			self.rate.add(self.lastTime, self.total)
+			self.diff.add(self.lastTime, self.total)
+			self.rain24h = self.day.add(self.lastTime, self.total)
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help"])
+
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+
+	if not args:
+		usage(progname)
+		return
+
+	acc = RainAccumulator(args[0])
+	if acc.lastTime is None:
+		warn("no rain state in", args[0])
+		return
+	stdout.write("as of %s: counter %.2f\n" % (time.ctime(acc.lastTime), acc.last))
+	for (name, n) in kPeriods:
+		stdout.write("%-6s %.2f\n" % (name, acc.totals[name]))
+	stdout.write("total  %.2f (%d wraps, %d resets)\n" % (acc.total, acc.wraps, acc.resets))
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
@@ -0,0 +1,217 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args] file [t1 [t2]]
+
+	Append-only file of fixed-width binary records that start with a
+	timestamp.  Records are read back through mmap and looked up by time
+	with a bisect.  Prints the records from t1 to t2 (seconds since the
+	epoch, default all of them).
+"""
+
+
+import os, sys, string, time, getopt, struct, mmap, bisect
+from log import *
+
+
+kMagic = "PYWX"
+kVersion = 1
+
+## magic, version, header size, record size
+header_struct = struct.Struct('<4sHHH')
+
+## seconds between fsync()s of appended records
+kSyncInterval = 60
+
+
+class _Times:
+	"""The timestamps of a RecordFile as a sequence, for bisect."""
+	def __init__(self, rf, mm, n):
+		self.rf = rf
+		self.mm = mm
+		self.n = n
+
+	def __len__(self):
+		return self.n
+
+	def __getitem__(self, i):
+		rf = self.rf
+		return rf.record_struct.unpack_from(self.mm, rf.headerSize + i * rf.recordSize)[0]
+
+
+class RecordFile:
+	"""Fixed-width records with struct format fmt, the first field of
+	which is the time.  names describes the fields and is kept in the
+	header: a file written with other fields is moved aside to path.old
+	and a new one started.
+
+	Records are appended in time order; older ones are dropped.  Appends
+	are buffered and fsync()ed at most every syncInterval seconds, and a
+	partial record left by a crash is cut off when the file is opened.
+
+	With readonly the file is never changed, so it can be read while
+	another process appends to it: a partial record at the end is left
+	alone and not counted.
+	"""
+	def __init__(self, path, fmt, names, syncInterval=kSyncInterval, readonly=0):
+		self.path = path
+		self.readonly = readonly
+		self.record_struct = struct.Struct(fmt)
+		self.recordSize = self.record_struct.size
+		self.names = names
+		self.syncInterval = syncInterval
+
+		desc = fmt + " " + string.join(names, ",")
+		self.headerSize = header_struct.size + len(desc)
+		self.header = header_struct.pack(kMagic, kVersion, self.headerSize, self.recordSize) + desc
+
+		self.fp = None
+		self.mm = None
+		self.mmsize = 0
+		self.lastTime = None
+		self.lastSync = 0
+		self.pending = 0
+
+		self.open()
+
+	def open(self):
+		if self.readonly:
+			self.fp = open(self.path, "rb")
+			if self.fp.read(self.headerSize) != self.header:
+				self.fp.close()
+				raise IOError, "record file %s has another format" % self.path
+			n = len(self)
+			if n: self.lastTime = self.read(n - 1)[0]
+			return
+
+		if os.path.exists(self.path):
+			fp = open(self.path, "rb")
+			header = fp.read(self.headerSize)
+			fp.close()
+			if header != self.header:
+				warn("record file", self.path, "has another format, moving it to", self.path + ".old")
+				os.rename(self.path, self.path + ".old")
+
+		if not os.path.exists(self.path):
+			fp = open(self.path, "wb")
+			fp.write(self.header)
+			fp.close()
+
+		self.fp = open(self.path, "r+b")
+		size = os.fstat(self.fp.fileno()).st_size
+		extra = (size - self.headerSize) % self.recordSize
+		if extra:
+			warn("record file", self.path, "dropping", extra, "bytes of a partial record")
+			self.fp.truncate(size - extra)
+		self.fp.seek(0, 2)
+
+		n = len(self)
+		if n: self.lastTime = self.read(n - 1)[0]
+
+	def close(self):
+		if self.mm is not None:
+			self.mm.close()
+			self.mm = None
+		if self.fp is not None:
+			self.sync()
+			self.fp.close()
+			self.fp = None
+
+	def __len__(self):
+		self.fp.flush()
+		size = os.fstat(self.fp.fileno()).st_size
+		return (size - self.headerSize) / self.recordSize
+
+	def append(self, rec):
+		"""Append rec, a tuple matching the format; False if it is older
+		than the last record."""
+		if self.readonly: raise IOError, "record file %s is open read-only" % self.path
+		t = rec[0]
+		if self.lastTime is not None and t < self.lastTime: return 0
+		self.fp.write(self.record_struct.pack(*rec))
+		self.lastTime = t
+		self.pending = self.pending + 1
+
+		now = time.time()
+		if now - self.lastSync >= self.syncInterval:
+			self.sync(now)
+		return 1
+
+	def sync(self, now=None):
+		if now is None: now = time.time()
+		self.lastSync = now
+		if not self.pending: return
+		self.fp.flush()
+		os.fsync(self.fp.fileno())
+		self.pending = 0
+
+	def view(self):
+		"""the whole file mapped, remapped when it has grown"""
+		self.fp.flush()
+		size = os.fstat(self.fp.fileno()).st_size
+		if self.mm is None or self.mmsize != size:
+			## the old map is left to be closed when the last reader is done
+			self.mm = mmap.mmap(self.fp.fileno(), size, access=mmap.ACCESS_READ)
+			self.mmsize = size
+		return self.mm
+
+	def read(self, i):
+		return self.record_struct.unpack_from(self.view(), self.headerSize + i * self.recordSize)
+
+	def indexRange(self, t1, t2):
+		"""(i, j) such that records i..j-1 are the ones from t1 to t2"""
+		mm = self.view()
+		times = _Times(self, mm, (self.mmsize - self.headerSize) / self.recordSize)
+		return bisect.bisect_left(times, t1), bisect.bisect_right(times, t2)
+
+	def records(self, t1, t2):
+		"""the records from t1 to t2, oldest first"""
+		i, j = self.indexRange(t1, t2)
+		mm = self.mm
+		unpack_from = self.record_struct.unpack_from
+		off = self.headerSize + i * self.recordSize
+		for k in xrange(i, j):
+			yield unpack_from(mm, off)
+			off = off + self.recordSize
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help"])
+
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+
+	if not args:
+		usage(progname)
+		return
+
+	fp = open(args[0], "rb")
+	magic, version, headerSize, recordSize = header_struct.unpack(fp.read(header_struct.size))
+	desc = fp.read(headerSize - header_struct.size)
+	fp.close()
+	if magic != kMagic:
+		warn(args[0], "is not a record file")
+		return
+	fmt, names = string.split(desc, " ", 1)
+
+	t1 = 0
+	t2 = sys.maxint
+	if len(args) > 1: t1 = float(args[1])
+	if len(args) > 2: t2 = float(args[2])
+
+	rf = RecordFile(args[0], fmt, string.split(names, ","), readonly=1)
+	stdout.write(string.join(rf.names, "\t") + "\n")
+	for rec in rf.records(t1, t2):
+		stdout.write(string.join(map(str, rec), "\t") + "\n")
+	rf.close()
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
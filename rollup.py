@@ -0,0 +1,255 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args] prefix [t1 [t2]]
+
+	Minute, hour and day summaries of the samples, kept up to date as
+	samples arrive and written to prefix.<level>.dat as each one closes.
+	Prints the summaries from t1 to t2.
+
+	--level=L    minute, hour or day (default hour)
+	--field=F    the field to print (default outside_temp)
+"""
+
+
+import os, sys, string, time, getopt, math
+from log import *
+
+import recordfile
+import rain
+
+
+## (name, seconds); a day runs from local midnight to midnight
+kLevels = [('minute', 60), ('hour', 3600), ('day', 86400)]
+
+## fields summarized as min, max, mean and last
+kFields = ['inside_temp', 'outside_temp', 'wind_speed', 'wind_gust_speed',
+					 'barometer', 'inside_humidity', 'outside_humidity', 'dewpoint']
+
+kMissing = float('nan')
+
+
+def bucketStart(t, period):
+	if period == 86400:
+		lt = time.localtime(t)
+		return time.mktime((lt[0], lt[1], lt[2], 0, 0, 0, 0, 0, -1))
+	return t - t % period
+
+
+class Summary:
+	"""One open bucket: count, rain, the wind vector and running min, max,
+	sum and last value of every field."""
+	def __init__(self, start, nfields):
+		self.start = start
+		self.count = 0
+		self.rain = 0.0
+		self.wind_x = 0.0
+		self.wind_y = 0.0
+		self.min = [None] * nfields
+		self.max = [None] * nfields
+		self.sum = [0.0] * nfields
+		self.n = [0] * nfields
+		self.last = [None] * nfields
+
+	def add(self, values, rain, speed, direction):
+		self.count = self.count + 1
+		self.rain = self.rain + rain
+		if speed and direction is not None:
+			a = math.radians(direction)
+			self.wind_x = self.wind_x + speed * math.sin(a)
+			self.wind_y = self.wind_y + speed * math.cos(a)
+
+		i = 0
+		for v in values:
+			if v is not None:
+				if self.n[i] == 0 or v < self.min[i]: self.min[i] = v
+				if self.n[i] == 0 or v > self.max[i]: self.max[i] = v
+				self.sum[i] = self.sum[i] + v
+				self.n[i] = self.n[i] + 1
+				self.last[i] = v
+			i = i + 1
+
+	def wind_direction(self):
+		"""speed weighted vector mean of the wind direction, None when calm"""
+		if not self.wind_x and not self.wind_y: return None
+		return math.degrees(math.atan2(self.wind_x, self.wind_y)) % 360
+
+	def mean(self, i):
+		if not self.n[i]: return None
+		return self.sum[i] / self.n[i]
+
+	def record(self):
+		rec = [self.start, self.count, self.rain, _missing(self.wind_direction())]
+		for i in range(len(self.n)):
+			rec.extend([_missing(self.min[i]), _missing(self.max[i]),
+									_missing(self.mean(i)), _missing(self.last[i])])
+		return rec
+
+
+def _missing(v):
+	if v is None: return kMissing
+	return v
+
+
+class Rollup:
+	"""Summaries of one level.  The open summary is closed and written
+	out when the first sample of the next bucket arrives."""
+	def __init__(self, name, period, fields, path=None, readonly=0):
+		self.name = name
+		self.period = period
+		self.fields = fields
+		self.current = None
+		self.closed = 0
+
+		self.file = None
+		self.resumeAt = None
+		## a level not written yet has nothing to read
+		if readonly and path and not os.path.exists(path): path = None
+		if path:
+			names = ['start', 'count', 'rain', 'wind_direction']
+			for field in fields:
+				names.extend([field + '_min', field + '_max', field + '_mean', field + '_last'])
+			self.file = recordfile.RecordFile(path, '<dIdd' + 'dddd' * len(fields), names, readonly=readonly)
+			## samples before the end of the last stored bucket are ignored
+			if len(self.file):
+				self.resumeAt = bucketStart(self.file.lastTime + period * 1.5, period)
+
+	def add(self, t, values, rain, speed, direction):
+		"""Returns the summary that was closed by this sample, if any."""
+		if self.resumeAt is not None and t < self.resumeAt: return None
+		start = bucketStart(t, self.period)
+
+		ret = None
+		cur = self.current
+		if cur is not None and start != cur.start:
+			if start < cur.start: return None
+			ret = self.close()
+			cur = None
+		if cur is None:
+			cur = self.current = Summary(start, len(self.fields))
+		cur.add(values, rain, speed, direction)
+		return ret
+
+	def close(self):
+		cur = self.current
+		self.current = None
+		if cur is None: return None
+		self.closed = self.closed + 1
+		if self.file is not None: self.file.append(cur.record())
+		return cur
+
+	def query(self, t1, t2):
+		"""The closed summaries starting from t1 to t2, as dictionaries with
+		start, count, rain, wind_direction and (min, max, mean, last) per
+		field; missing values are None."""
+		ret = []
+		if self.file is None: return ret
+		for rec in self.file.records(t1, t2):
+			rec = map(_none, rec)
+			d = {'start': rec[0], 'count': rec[1], 'rain': rec[2], 'wind_direction': rec[3]}
+			i = 4
+			for field in self.fields:
+				d[field] = tuple(rec[i:i+4])
+				i = i + 4
+			ret.append(d)
+		return ret
+
+
+def _none(v):
+	if v != v: return None
+	return v
+
+
+class Rollups:
+	"""Every level of kLevels, fed one sample at a time."""
+	def __init__(self, prefix=None, levels=kLevels, fields=kFields, readonly=0):
+		self.fields = fields
+		self.levels = []
+		self.byName = {}
+		for (name, period) in levels:
+			path = None
+			if prefix: path = "%s.%s.dat" % (prefix, name)
+			r = Rollup(name, period, fields, path, readonly)
+			self.levels.append(r)
+			self.byName[name] = r
+		self.lastTime = None
+
+	def add(self, t, si, rain=0.0):
+		"""rain is what fell since the previous sample, as counted by a
+		rain.RainAccumulator."""
+		if self.lastTime is not None and t < self.lastTime: return
+		self.lastTime = t
+
+		values = []
+		for field in self.fields:
+			values.append(getattr(si, field))
+
+		for r in self.levels:
+			r.add(t, values, rain, si.wind_speed, si.wind_direction)
+
+	def resume(self, samples, wrap=None):
+		"""Refill the open summaries from (t, SensorImage) pairs, usually
+		the stored samples since the oldest open bucket began, counting
+		their rain with an accumulator of their own (wrap as in
+		rain.RainAccumulator)."""
+		acc = rain.RainAccumulator(wrap=wrap)
+		for (t, si) in samples:
+			self.add(t, si, acc.add(t, si))
+
+	def resumeFrom(self, now):
+		"""where resume() has to start"""
+		t = now
+		for r in self.levels:
+			start = bucketStart(now, r.period)
+			if r.resumeAt is not None: start = max(start, r.resumeAt)
+			t = min(t, start)
+		return t
+
+	def query(self, level, t1, t2):
+		return self.byName[level].query(t1, t2)
+
+	def current(self, level):
+		return self.byName[level].current
+
+	def close(self):
+		for r in self.levels:
+			if r.file is not None: r.file.close()
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help", "level=", "field="])
+
+	level = 'hour'
+	field = 'outside_temp'
+	for (opt, val) in list:
+		if opt == "--help":
+			usage(progname)
+			return
+		elif opt == "--level":
+			level = val
+		elif opt == "--field":
+			field = val
+
+	if not args:
+		usage(progname)
+		return
+
+	t1 = 0
+	t2 = sys.maxint
+	if len(args) > 1: t1 = float(args[1])
+	if len(args) > 2: t2 = float(args[2])
+
+	rollups = Rollups(args[0], readonly=1)
+	for d in rollups.query(level, t1, t2):
+		stdout.write("%s %5d rain %.2f dir %s %s %s\n" % (time.strftime("%Y-%m-%d %H:%M", time.localtime(d['start'])),
+																									d['count'], d['rain'], d['wind_direction'], field, d[field]))
+	rollups.close()
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
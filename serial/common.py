@@ -6,9 +6,9 @@ TRUE = 1
 FALSE = 0
 PORT_CLOSED = None
 
-TimeoutError = "TimeoutError"
-SerialError = "SerialError"
-UnimplementedError = 'UnimplementedError'
+class TimeoutError(Exception): pass
+class SerialError(Exception): pass
+class UnimplementedError(Exception): pass
 
 COM1 = 0
 COM2 = 1
@@ -91,6 +91,19 @@ class TcpPort:
 		retdata = string.join(buffer, '')
 		return retdata
 
+	def readsome(self, cnt, timed=0):
+		if timed == 1: timeout = self.cfg['timeOutMs']/1000.
+		else:          timeout = 0
+
+		r, w, x = select.select([self._fd], [], [self._fd], timeout)
+
+		if len(r) == 0 and len(w) ==0 and len(x) == 0:
+			if timed == 1:
+				raise TimeoutError, "Timeout: Unable to read from port: '%s:%s'" % (self.iphost, self.ipport)
+			return ''
+
+		return self._read(cnt)
+
 	def fileno(self):
 		return self._fd
 
@@ -219,6 +232,11 @@ class Port:
 			"""
 			return self.port.read(cnt, timed)
 
+	def readsome(self, cnt, timed=FALSE):
+			"""Return up to cnt bytes that are waiting on the port.  If timed
+			is TRUE, wait up to the cfg time for the first byte to arrive."""
+			return self.port.readsome(cnt, timed)
+
 	def readTerminated(self, term):
 			"""Read from port until terminator read, timed out, or buf overflow.
 			Terminator is stripped off of result."""
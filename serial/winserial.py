@@ -43,7 +43,7 @@ PORT_CLOSED = -1
 
 TimeoutError = SioError
 SerialError = SioError
-UnimplementedError = 'UnimplementedError'
+class UnimplementedError(Exception): pass
 
 Mode_Raw = 0
 Mode_Flow = 1
@@ -0,0 +1,312 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args] spoolfile
+
+	Uploads that could not be sent, kept on disk until they are.  Prints
+	the entries waiting in a spool.
+
+	--clear      throw away the entries waiting
+"""
+
+
+import os, sys, string, time, getopt, threading
+from log import *
+
+
+## seconds between fsync()s of appended entries
+kSyncInterval = 10
+
+## entries sent at a time, and so in flight at once
+kBatch = 20
+
+## entries sent per second at most
+kRate = 2.0
+
+## seconds to wait after a failed batch, doubled up to kMaxRetryInterval
+kRetryInterval = 60
+kMaxRetryInterval = 15 * 60
+
+
+class Spool:
+	"""Append-only file of entries, one line each, and the offset of the
+	first one not yet sent, kept in path.offset.  Appends are fsync()ed at
+	most every syncInterval seconds and a partial line left by a crash is
+	cut off when the spool is opened.  Once every entry has been sent the
+	file is emptied.
+
+	The offset file is replaced without an fsync(), so a crash can lose
+	it and have entries sent again; that is harmless for uploads keyed by
+	their time.  Safe to use from several threads.
+	"""
+	def __init__(self, path, syncInterval=kSyncInterval):
+		self.path = path
+		self.syncInterval = syncInterval
+		self.lock = threading.Lock()
+
+		self.fp = None
+		self.offset = 0
+		self.size = 0
+		self.waiting = 0
+		self.lastSync = 0
+		self.pending = 0
+
+		self.appended = 0
+		self.sent = 0
+
+		self.open()
+
+	def open(self):
+		self.fp = open(self.path, "ab")
+		self.fp.seek(0, 2)
+		self.size = self.fp.tell()
+		end = self._lastLine()
+		if end < self.size:
+			warn("spool", self.path, "dropping", self.size - end, "bytes of a partial entry")
+			self.fp.truncate(end)
+			self.size = end
+
+		self.offset = 0
+		try:
+			fp = open(self.path + ".offset")
+			self.offset = int(fp.read())
+			fp.close()
+		except (IOError, ValueError):
+			pass
+		if self.offset > self.size: self.offset = 0
+
+		self.waiting = 0
+		fp = open(self.path, "rb")
+		fp.seek(self.offset)
+		for line in fp: self.waiting = self.waiting + 1
+		fp.close()
+
+	def _lastLine(self):
+		"""the offset just past the last newline"""
+		fp = open(self.path, "rb")
+		end = self.size
+		while end > 0:
+			n = min(end, 4096)
+			fp.seek(end - n)
+			i = string.rfind(fp.read(n), "\n")
+			if i >= 0:
+				end = end - n + i + 1
+				break
+			end = end - n
+		fp.close()
+		return end
+
+	def __len__(self):
+		return self.waiting
+
+	def append(self, entry):
+		self.lock.acquire()
+		try:
+			line = entry + "\n"
+			self.fp.write(line)
+			self.size = self.size + len(line)
+			self.waiting = self.waiting + 1
+			self.appended = self.appended + 1
+			self.pending = self.pending + 1
+			now = time.time()
+			if now - self.lastSync >= self.syncInterval: self._sync(now)
+		finally:
+			self.lock.release()
+
+	def sync(self):
+		self.lock.acquire()
+		try:
+			self._sync(time.time())
+		finally:
+			self.lock.release()
+
+	def _sync(self, now):
+		self.lastSync = now
+		if not self.pending: return
+		self.fp.flush()
+		os.fsync(self.fp.fileno())
+		self.pending = 0
+
+	def read(self, n):
+		"""Up to n of the oldest entries, as (entry, offset past it)."""
+		self.lock.acquire()
+		try:
+			self.fp.flush()
+			offset = self.offset
+			end = self.size
+		finally:
+			self.lock.release()
+
+		ret = []
+		if offset >= end: return ret
+		fp = open(self.path, "rb")
+		fp.seek(offset)
+		while len(ret) < n and offset < end:
+			line = fp.readline()
+			if line[-1:] != "\n": break
+			offset = offset + len(line)
+			ret.append((line[:-1], offset))
+		fp.close()
+		return ret
+
+	def commit(self, offset, n):
+		"""The n entries up to offset have been sent."""
+		self.lock.acquire()
+		try:
+			self.offset = offset
+			self.waiting = max(0, self.waiting - n)
+			self.sent = self.sent + n
+			if self.offset >= self.size:
+				## all sent: start over with an empty file
+				self.fp.truncate(0)
+				self.fp.seek(0)
+				self.size = 0
+				self.offset = 0
+				self.waiting = 0
+				self.pending = 0
+			tmp = self.path + ".offset.tmp"
+			fp = open(tmp, "w")
+			fp.write("%d\n" % self.offset)
+			fp.close()
+			os.rename(tmp, self.path + ".offset")
+		finally:
+			self.lock.release()
+
+	def stats(self):
+		return {'waiting': self.waiting, 'appended': self.appended, 'sent': self.sent}
+
+	def close(self):
+		self.sync()
+		self.fp.close()
+
+
+class Replayer:
+	"""Drains a Spool on its own thread.
+
+	send(entries) uploads a batch and returns how many of them, from the
+	front, were dealt with, sent or turned down for good; an exception or
+	0 means try again later.  batch entries are sent at a time, at most
+	rate a second.  After a failure it waits retryInterval seconds,
+	doubling up to kMaxRetryInterval, and with nothing to send it looks
+	again every syncInterval, but wake() cuts either wait short once the
+	other end is answering again.
+	"""
+	def __init__(self, spool, send, batch=kBatch, rate=kRate, retryInterval=kRetryInterval):
+		self.spool = spool
+		self.send = send
+		self.batch = batch
+		self.rate = rate
+		self.retryInterval = retryInterval
+
+		self.cond = threading.Condition()
+		self.woken = 0
+		self.interruptible = 0
+
+		self.batches = 0
+		self.failures = 0
+
+		self.thread = threading.Thread(target=self._run, name="replay-" + os.path.basename(spool.path))
+		self.thread.setDaemon(1)
+		self.thread.start()
+
+	def wake(self):
+		"""Cut short a wait after a failure or for more entries; a wait
+		that keeps to the rate is not."""
+		cond = self.cond
+		cond.acquire()
+		try:
+			if self.interruptible:
+				self.woken = 1
+				cond.notify()
+		finally:
+			cond.release()
+
+	def wait(self, delay):
+		cond = self.cond
+		cond.acquire()
+		try:
+			end = time.time() + delay
+			while not self.woken:
+				left = end - time.time()
+				if left <= 0: break
+				cond.wait(left)
+			self.woken = 0
+		finally:
+			cond.release()
+
+	def _run(self):
+		retry = self.retryInterval
+		delay = 0
+		while 1:
+			if delay > 0: self.wait(delay)
+			self.interruptible = 0
+			spool = self.spool
+			spool.sync()
+
+			items = spool.read(self.batch)
+			if not items:
+				self.interruptible = 1
+				delay = spool.syncInterval
+				continue
+
+			start = time.time()
+			n = 0
+			try:
+				n = self.send(map(lambda item: item[0], items))
+			except:
+				import traceback
+				traceback.print_exc()
+			if not n:
+				self.failures = self.failures + 1
+				self.interruptible = 1
+				delay = retry
+				retry = min(retry * 2, kMaxRetryInterval)
+				continue
+
+			self.batches = self.batches + 1
+			spool.commit(items[n-1][1], n)
+			if spool.waiting == 0: log("spool", spool.path, "drained,", spool.sent, "sent")
+			retry = self.retryInterval
+			delay = n / self.rate - (time.time() - start)
+
+	def stats(self):
+		ret = self.spool.stats()
+		ret['batches'] = self.batches
+		ret['failures'] = self.failures
+		return ret
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help", "clear"])
+
+	clear = 0
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+		elif field == "--clear":
+			clear = 1
+
+	if not args:
+		usage(progname)
+		return
+
+	spool = Spool(args[0])
+	if clear:
+		n = len(spool)
+		spool.commit(spool.size, n)
+		stdout.write("cleared %d entries\n" % n)
+	else:
+		for (entry, offset) in spool.read(len(spool)):
+			stdout.write(entry + "\n")
+		stdout.write("%d waiting\n" % len(spool))
+	spool.close()
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
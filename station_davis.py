@@ -2,6 +2,8 @@
 
 """
 usage: %(progname)s [args]
+
+	--bench      compare LOOP decoding speed before and after
 """
 
 
@@ -13,7 +15,10 @@ import struct
 import serial
 import weather
 import weather_util
+import rollup
+import rain
 from weather_util import fromBCD, toBCD
+from crc16 import compute_crc, verify_frames
 
 gDavisModels = {}
 gDavisModels[0] = "Davis Wizard III"
@@ -26,6 +31,227 @@ gDavisModels[6] = "Davis Health"
 
 ACK = 6
 
+## the nibble count of WRD/WWR is a 4 bit field; transfers are kept byte
+## aligned so that each one packs into whole bytes.
+kMaxNibbles = 14
+
+## bank 1 locations read at startup
+kTimeRange = (0xBE, 13)
+kCalibrationRanges = [(0x2C, 4), (0x52, 4), (0x78, 4), (0xD6, 8)]
+
+## inside temp, outside temp, wind speed, wind direction, barometer,
+## inside/outside humidity, total rain, unused, CRC
+loop_struct = struct.Struct('<hhBhhBBhhh')
+
+## WeatherLink archive memory.  The link keeps its new/old record
+## pointers in its own memory (bank 1, 4 nibbles each) and the records
+## in a ring in SRAM.  An SRD block is followed by its CRC.
+kArchiveSize = 32768
+kArchiveRecordSize = 21
+kArchiveRecords = kArchiveSize / kArchiveRecordSize
+kArchiveBlockRecords = 12
+kArchiveBatchBlocks = 8
+kArchiveNewPtr = 0x0A
+kArchiveOldPtr = 0x0E
+
+## barometer, inside/outside humidity, rain clicks, avg inside/outside
+## temp, avg wind, wind direction code, hi outside temp, hi wind,
+## day, month, hour, minute (BCD), low outside temp
+archive_struct = struct.Struct('<HBBHhhBBhBBBBBh')
+
+## rewrite the console clock when it is predicted to be off by more
+## than this many seconds; read it at least this often
+kClockMaxError = 30
+kClockCheckInterval = 6 * 3600
+kClockHistory = 8
+
+## consecutive resumes without a good sample before a full handshake
+kResumeAttempts = 3
+
+## only look at the archive after a gap longer than this (seconds)
+kCatchupMinGap = 300
+
+## reads of an archive block, or of the LOOP packet that anchors the
+## catch-up, before giving up on it
+kArchiveTries = 3
+
+
+class ConsoleClock:
+	"""Offset and drift of the console clock against the host clock.
+
+	Fitted by least squares over the last few (host time, offset)
+	readings, so the error at any later time can be predicted without
+	talking to the console.
+	"""
+	def __init__(self, history=kClockHistory):
+		self.history = history
+		self.points = []
+		self.rate = 0.0
+
+	def add(self, host_t, console_t):
+		self.points.append((host_t, console_t - host_t))
+		if len(self.points) > self.history:
+			del self.points[0]
+		self.rate = self.drift()
+
+	def reset(self, host_t=None):
+		"""The clock was just set at host_t: offset is zero.  Without
+		host_t the readings are forgotten, as after a console reset.  The
+		drift rate stays either way."""
+		if host_t is None: self.points = []
+		else: self.points = [(host_t, 0.0)]
+
+	def drift(self):
+		"""seconds gained per second"""
+		n = len(self.points)
+		if n < 2: return self.rate
+		mt = 0.0
+		mo = 0.0
+		for (t, o) in self.points:
+			mt = mt + t
+			mo = mo + o
+		mt = mt / n
+		mo = mo / n
+		num = 0.0
+		den = 0.0
+		for (t, o) in self.points:
+			num = num + (t - mt) * (o - mo)
+			den = den + (t - mt) * (t - mt)
+		if den == 0: return self.rate
+		return num / den
+
+	def predict(self, t):
+		"""predicted console minus host time at t, None if never read"""
+		if not self.points: return None
+		t0, o0 = self.points[-1]
+		return o0 + self.rate * (t - t0)
+
+	def lastRead(self):
+		if not self.points: return 0
+		return self.points[-1][0]
+
+
+class ConsoleMemory:
+	"""Cached image of the console's two processor memory banks.
+
+	Memory is addressed in nibbles.  Reads are served from the image and
+	only the nibbles that are not loaded yet go over the wire, in as few
+	WRD transfers as possible.  Writes update the image and are marked
+	dirty until flush() sends them with WWR.  The image is dropped on
+	every handshake, since the console may have been reset or swapped.
+	"""
+	def __init__(self, logger):
+		self.logger = logger
+		self.image = {0: [None] * 256, 1: [None] * 256}
+		self.dirty = {0: {}, 1: {}}
+		self.fresh = {0: {}, 1: {}}				## loaded since the last flush
+
+		self.reads = 0
+		self.writes = 0
+
+	def invalidate(self, bank=None):
+		if bank is None: banks = [0, 1]
+		else: banks = [bank]
+		for bank in banks:
+			self.image[bank] = [None] * 256
+			self.dirty[bank] = {}
+			self.fresh[bank] = {}
+
+	def _store(self, bank, addr, n, data):
+		image = self.image[bank]
+		for i in range(n):
+			c = ord(data[i >> 1])
+			if i & 1: c = c >> 4
+			image[(addr + i) & 0xff] = c & 0x0f
+
+	def _fetch(self, bank, addr, n):
+		image = self.image[bank]
+		ret = []
+		for i in range(0, n, 2):
+			c = image[(addr + i) & 0xff]
+			if i + 1 < n: c = c | (image[(addr + i + 1) & 0xff] << 4)
+			ret.append(chr(c))
+		return string.join(ret, '')
+
+	def load(self, bank, addr, n):
+		"""Read n nibbles from the console into the image."""
+		addr = addr & 0xff
+		while n > 0:
+			cnt = min(n, kMaxNibbles)
+			data = self.logger._ReadWRD(cnt, bank, addr)
+			self.reads = self.reads + 1
+			self._store(bank, addr, cnt, data)
+			fresh = self.fresh[bank]
+			for i in range(cnt):
+				fresh[(addr + i) & 0xff] = 1
+			addr = addr + cnt
+			n = n - cnt
+
+	def prefetch(self, bank, ranges, refresh=0):
+		"""Load a list of (addr, n) ranges, merging neighbouring ranges
+		into a single transfer when they fit."""
+		image = self.image[bank]
+		want = []
+		for (addr, n) in ranges:
+			addr = addr & 0xff
+			if not refresh and None not in image[addr:addr+n]: continue
+			want.append((addr, addr + n))
+		want.sort()
+
+		spans = []
+		for (a, e) in want:
+			if spans and e - spans[-1][0] <= kMaxNibbles:
+				spans[-1][1] = max(spans[-1][1], e)
+			else:
+				spans.append([a, e])
+
+		for (a, e) in spans:
+			self.load(bank, a, e - a)
+
+	def read(self, n, bank, addr, refresh=0):
+		addr = addr & 0xff
+		self.prefetch(bank, [(addr, n)], refresh)
+		return self._fetch(bank, addr, n)
+
+	def write(self, n, bank, addr, data):
+		addr = addr & 0xff
+		self._store(bank, addr, n, data)
+		dirty = self.dirty[bank]
+		for i in range(n):
+			dirty[(addr + i) & 0xff] = 1
+
+	def flush(self):
+		"""Write back the dirty nibbles.  Runs separated by a gap of
+		clean nibbles go out as one transfer only when the whole gap was
+		read from the console since the last flush, so an older cached
+		value is never written back over the console's own."""
+		for bank in (0, 1):
+			dirty = self.dirty[bank]
+			fresh = self.fresh[bank]
+			self.fresh[bank] = {}
+			if not dirty: continue
+
+			addrs = dirty.keys()
+			addrs.sort()
+
+			spans = []
+			for a in addrs:
+				if spans and a + 1 - spans[-1][0] <= kMaxNibbles \
+					 and self._bridges(fresh, spans[-1][1], a):
+					spans[-1][1] = a + 1
+				else:
+					spans.append([a, a + 1])
+
+			for (a, e) in spans:
+				self.logger._WriteWRD(e - a, bank, a, self._fetch(bank, a, e - a))
+				self.writes = self.writes + 1
+			self.dirty[bank] = {}
+
+	def _bridges(self, fresh, a, e):
+		for i in range(a, e):
+			if not fresh.has_key(i): return 0
+		return 1
+
 
 class DataLogger:
 	def __init__(self, config, port):
@@ -42,16 +268,69 @@ class DataLogger:
 		self.barcal = 0
 		self.windcal = 0
 
+		self.memory = ConsoleMemory(self)
+
+		self.lastSampleTime = 0
+		self.clock = ConsoleClock()
+
+		## session state kept across serial errors
+		self.session = 0
+		self.model = None
+		self.resumes = 0
+		self.failedAt = 0
+		self.handshakes = 0
+		self.resumed = 0
+		self.samples = weather.Samples()
+		self.scheduler = None
+
+		path = getattr(config, 'kRainState', None)
+		if path:
+			self.samples.rain = rain.RainAccumulator(path, diffWindow=weather.kRainInterval)
+
+		path = getattr(config, 'kSampleStore', None)
+		if path:
+			store = weather.SampleStore(path, getattr(config, 'kSampleStoreSync', weather.kSampleStoreSync))
+			self.samples.attach(store, time.time())
+			if len(self.samples): self.lastSampleTime = self.samples.times[-1]
+
+		prefix = getattr(config, 'kRollupStore', None)
+		if prefix:
+			self.samples.attachRollups(rollup.Rollups(prefix), time.time())
+
+	def Reopen(self):
+		"""Close the port and open it again, for a dropped connection.  The
+		session is kept, so StartLoop() resumes without a handshake."""
+		try:
+			self.port.close()
+		except:
+			pass
+		self.port = serial.open(GetSerialConfig(self.config))
+
 	def SetUpdater(self, updater):
+		"""Add a sink.  Unless config.kAsyncUpdaters is off it runs on its
+		own thread, see weather.AsyncUpdater."""
+		if getattr(self.config, 'kAsyncUpdaters', 0):
+			policy = updater.queuePolicy or getattr(self.config, 'kUpdaterPolicy', weather.kDropOldest)
+			updater = weather.AsyncUpdater(updater, getattr(self.config, 'kUpdaterQueue', weather.kUpdaterQueue), policy)
 		self.updaters.append(updater)
 
+	def UpdaterStats(self):
+		ret = {}
+		for updater in self.updaters:
+			if isinstance(updater, weather.AsyncUpdater):
+				ret[updater.name] = updater.stats()
+		return ret
+
 	def get_acknowledge(self):
 		c = self.port.read(1, timed=1)
 
 		if ord(c) != ACK:
-			raise weather.CommError
+			raise weather.CommError, "expected ACK, got %d" % ord(c)
 
 	def ReadWRD(self, n, bank, addr):
+		return self.memory.read(n, bank, addr)
+
+	def _ReadWRD(self, n, bank, addr):
 		if bank == 0: bankval = 2
 		elif bank == 1: bankval = 4
 		self.port.write("WRD" + chr((n << 4) | bankval) + chr(addr & 0x00ff) + chr(0xd))
@@ -77,6 +356,9 @@ class DataLogger:
 		self.WriteWRD(4, bank, addr, bytes)
 
 	def WriteWRD(self, n, bank, addr, data):
+		self.memory.write(n, bank, addr, data)
+
+	def _WriteWRD(self, n, bank, addr, data):
 		if bank == 0: bankval = 1
 		elif bank == 1: bankval = 3
 		self.port.write("WWR" + chr((bankval) | (n << 4)) + chr(addr & 0x00ff) + data + chr(0xd))
@@ -84,13 +366,31 @@ class DataLogger:
 
 
 
+	def _ReadRRD(self, n, bank, addr):
+		self.port.write("RRD" + chr(bank) + chr(addr & 0x00ff) + chr(n - 1) + chr(0xd))
+		self.get_acknowledge()
+
+		data = self.port.read((n+1)/2, timed=1)
+		return data
+
+	def _ReadSRD(self, addr, n):
+		self.port.write("SRD" + chr(addr & 0x00ff) + chr(addr >> 8) + chr(n - 1) + chr(0xd))
+		self.get_acknowledge()
+
+		data = self.port.read(n + 2, timed=1)
+		if len(data) != n + 2:
+			raise weather.CommError, "Invalid Length of Response to SRD: len %d" % len(data)
+		return data
+
 	def SendSTART(self):
 		self.port.write("START" + chr(0x0d))
 		self.get_acknowledge()
 
-	def SendLOOP(self):
-#		self.port.write("LOOP" + chr(0) + chr(1) + chr(0x0d))
-		self.port.write("LOOP" + chr(255) + chr(255) + chr(0x0d))
+	def SendLOOP(self, count=1):
+		## the console wants the two's complement of the packet count,
+		## low byte first: 0xffff asks for a single packet.
+		n = (65536 - count) & 0xffff
+		self.port.write("LOOP" + chr(n & 0xff) + chr(n >> 8) + chr(0x0d))
 		self.get_acknowledge()
 
 	def ReadLOOPResponse(self):
@@ -105,36 +405,36 @@ class DataLogger:
 		if compute_crc(s): 
 			raise weather.CommError, "CRC Error of Response to LOOP"
 
-		si = weather.SensorImage()
+		return self.DecodeLOOP(s)
+
+	def DecodeLOOP(self, s, si=None):
+		if si is None: si = weather.SensorImage()
 		self.ParseLoopResponse(si, s)
 
 		return si
 
 
-	def ParseLoopResponse(self, si, s):
-		if len(s) != 17: warn("wrong size", len(s))
-		rec = struct.unpack('<hhBhhBBhhh', s)
+	def ParseLoopResponse(self, si, s, offset=0):
+		if len(s) - offset < 17: warn("wrong size", len(s) - offset)
+		rec = loop_struct.unpack_from(s, offset)
 
 		si.sample_time = time.time()
 		si.inside_temp = (rec[0] + self.tp1cal) / 10.
 		si.outside_temp = (rec[1] + self.tp2cal) / 10.
 		si.wind_speed = (rec[2] * 1600.) / self.windcal
-		si.wind_gust_speed = si.wind_gust_speed
-		si.wind_direction = rec[3] 
+		si.wind_direction = rec[3]
 		si.barometer = (rec[4] + 370) / 1000.
-		si.seabarometer = si.barometer
 
 		si.inside_humidity = rec[5] + self.hm1cal
 		si.outside_humidity = rec[6] + self.hm2cal
 		if si.outside_humidity > 100: si.outside_humidity = 100
 		si.total_rain = rec[7] / (1.0 * self.rncal)
-
-		si.dewpoint = weather_util.DewCalc(si.outside_humidity, si.outside_temp)
-
-		crc = rec[8]
 		
 
 	def ReadTime(self):
+		## the clock keeps running, never trust the cached copy
+		self.memory.prefetch(1, [kTimeRange], refresh=1)
+
 		d = self.ReadWRD(6, 1, 0xBE)
 		hour = fromBCD(ord(d[0:1]))
 		min = fromBCD(ord(d[1:2]))
@@ -154,11 +454,60 @@ class DataLogger:
 		self.WriteWRD(6, 1, 0xBE, chr(toBCD(hour)) + chr(toBCD(min)) + chr(toBCD(sec)))
 
 		self.WriteWRD(3, 1, 0xC8, chr(toBCD(day)) + chr(month))
+		self.memory.flush()
+
+	def ConsoleTime(self):
+		"""the console clock as seconds since the epoch"""
+		month, day, hour, min, sec = self.ReadTime()
+
+		now = time.time()
+		year = time.localtime(now)[0]
+		best = None
+		for y in (year - 1, year, year + 1):
+			try:
+				t = time.mktime((y, month, day, hour, min, sec, 0, 0, -1))
+			except (OverflowError, ValueError):
+				continue
+			if best is None or abs(t - now) < abs(best - now): best = t
+		return best
+
+	def CheckClock(self, force=0):
+		"""Keep the console clock within kClockMaxError of the host.
+
+		The clock is only read when the last reading is older than
+		kClockCheckInterval, and only written when the predicted error
+		is over the limit.
+		"""
+		maxerror = getattr(self.config, 'kClockMaxError', kClockMaxError)
+		interval = getattr(self.config, 'kClockCheckInterval', kClockCheckInterval)
+
+		now = time.time()
+		err = self.clock.predict(now)
+		if not force and err is not None and now - self.clock.lastRead() < interval:
+			if abs(err) <= maxerror: return err
+
+		t1 = time.time()
+		ct = self.ConsoleTime()
+		t2 = time.time()
+		self.clock.add((t1 + t2) / 2., ct)
+
+		err = self.clock.predict(t2)
+		log("console clock off by %.1fs, drift %.2f s/day" % (err, self.clock.rate * 86400))
+		if abs(err) > maxerror:
+			warn("setting console clock, off by %.1fs" % err)
+			self.SetTime(time.time())
+			self.clock.reset(time.time())
+			err = 0.0
+		return err
 
 	def GetCalibration(self):
+		self.memory.prefetch(1, kCalibrationRanges)
+
 		self.tp1cal = self.ReadWord(1, 0x0152)
 		self.tp2cal = self.ReadWord(1, 0x0178)
 		self.rncal = self.ReadWord(1, 0x01D6)
+		## the LOOP rain total is a 16 bit click counter
+		self.samples.rain.wrap = 65536.0 / self.rncal
 		self.hm1cal = 0
 		self.hm2cal = self.ReadWord(1, 0x01DA)
 		self.barcal = self.ReadWord(1, 0x012C)
@@ -180,10 +529,176 @@ class DataLogger:
 		self.WriteWord(1, 0x01D6, rncal)
 		self.WriteWord(1, 0x01DA, h2mcal)
 		self.WriteWord(1, 0x012C, barcal)
+		self.memory.flush()
+
+
+	def ReadArchivePointers(self):
+		new = struct.unpack('<H', self._ReadRRD(4, 1, kArchiveNewPtr))[0]
+		old = struct.unpack('<H', self._ReadRRD(4, 1, kArchiveOldPtr))[0]
+		return new, old
+
+	def ReadArchiveBlocks(self, blocks):
+		"""Read a batch of (record index, count) blocks from SRAM and CRC
+		check them together.  A block that fails is read again, up to
+		kArchiveTries reads in all.  Returns a list of record strings per
+		block, or None for a block that never passed its check."""
+		data = []
+		for (i, cnt) in blocks:
+			data.append(self.ReadArchiveBlock(i, cnt))
+
+		sizes = {}
+		for d in data:
+			if d is None: sizes[None] = 1
+			else: sizes[len(d)] = 1
+		if len(sizes) == 1 and data[0] is not None:
+			ok = verify_frames(string.join(data, ''), len(data[0]), 0)
+		else:
+			ok = []
+			for d in data: ok.append(d is not None and not compute_crc(d))
+
+		ret = []
+		for j in range(len(data)):
+			d = data[j]
+			tries = 1
+			while not ok[j] and tries < kArchiveTries:
+				d = self.ReadArchiveBlock(blocks[j][0], blocks[j][1])
+				ok[j] = d is not None and not compute_crc(d)
+				tries = tries + 1
+			if not ok[j]:
+				warn("archive block at record", blocks[j][0], "failed", tries, "reads")
+				ret.append(None)
+				continue
+			recs = []
+			for k in range(blocks[j][1]):
+				recs.append(d[k * kArchiveRecordSize:(k+1) * kArchiveRecordSize])
+			ret.append(recs)
+		return ret
+
+	def ReadArchiveBlock(self, i, cnt):
+		"""cnt records from record i with their CRC, or None when the read
+		failed; the port is flushed after a failure."""
+		try:
+			return self._ReadSRD(i * kArchiveRecordSize, cnt * kArchiveRecordSize)
+		except (weather.CommError, serial.TimeoutError), msg:
+			warn("archive block at record", i, msg)
+			self.port.flush()
+			return None
+
+	def DecodeArchiveRecord(self, s, now=None):
+		rec = archive_struct.unpack(s)
+
+		if now is None: now = time.time()
+		lt = time.localtime(now)
+		day = fromBCD(rec[10])
+		month = fromBCD(rec[11])
+		year = lt[0]
+		if (month, day) > (lt[1], lt[2]): year = year - 1
+		t = time.mktime((year, month, day, fromBCD(rec[12]), fromBCD(rec[13]), 0, 0, 0, -1))
 
+		si = weather.SensorImage()
+		si.sample_time = t
+		si.barometer = rec[0] / 1000.
+		si.inside_humidity = rec[1] + self.hm1cal
+		si.outside_humidity = min(100, rec[2] + self.hm2cal)
+		si.inside_temp = (rec[4] + self.tp1cal) / 10.
+		si.outside_temp = (rec[5] + self.tp2cal) / 10.
+		si.wind_speed = (rec[6] * 1600.) / self.windcal
+		if rec[7] == 255: si.wind_direction = 0
+		else: si.wind_direction = int(rec[7] * 22.5)
+		si.wind_gust_speed = (rec[9] * 1600.) / self.windcal
+
+		return t, rec[3], si
+
+	def DownloadArchive(self, since, total_rain=None):
+		"""Fetch the archive records newer than since, newest block first,
+		and return them as a list of (t, SensorImage) in time order.
+
+		Archive records carry the rain of their own interval only; when
+		the current total_rain is known the running total is rebuilt
+		backwards from it so that rain derivatives line up with LOOP.
+		"""
+		new, old = self.ReadArchivePointers()
+		newest = (new / kArchiveRecordSize - 1) % kArchiveRecords
+		count = ((new - old) / kArchiveRecordSize) % kArchiveRecords
+
+		now = time.time()
+		records = []
+		idx = newest
+		done = 0
+		while count > 0 and not done:
+			blocks = []
+			while count > 0 and len(blocks) < kArchiveBatchBlocks:
+				cnt = min(count, kArchiveBlockRecords, idx + 1)
+				blocks.append((idx - cnt + 1, cnt))
+				idx = (idx - cnt) % kArchiveRecords
+				count = count - cnt
+
+			for recs in self.ReadArchiveBlocks(blocks):
+				if recs is None: continue
+				recs.reverse()
+				for r in recs:
+					t, clicks, si = self.DecodeArchiveRecord(r, now)
+					if t <= since:
+						done = 1
+						break
+					records.append((t, clicks, si))
+				if done: break
+
+		records.sort()
+
+		ret = []
+		if total_rain is not None:
+			total = total_rain
+			for j in range(len(records) - 1, -1, -1):
+				records[j][2].total_rain = total
+				total = total - records[j][1] / (1.0 * self.rncal)
+		else:
+			## missing, not the 0 an unset field reads as, which the rain
+			## accumulator would take for a reset counter
+			for (t, clicks, si) in records:
+				si.total_rain = None
+		for (t, clicks, si) in records:
+			ret.append((t, si))
+
+		return ret
+
+	def CatchUp(self, samples, since, total_rain=None):
+		"""Feed the archive records stored since the last sample into the
+		sample history in time order."""
+		records = self.DownloadArchive(since, total_rain)
+		if not records: return 0
+
+		warn("archive catch-up:", len(records), "records")
+		samples.addSamples(records)
+		for (t, si) in records:
+			for updater in self.updaters:
+				updater.backfill(si)
+		self.lastSampleTime = records[-1][0]
+		return len(records)
+
+	def CatchUpArchive(self, limit=None):
+		"""Catch up from the archive after a gap longer than kCatchupMinGap,
+		anchoring the rain total on a fresh LOOP packet.  limit caps how
+		many seconds of records are read.  Without a good LOOP packet after
+		kArchiveTries the records are still taken, without rain totals."""
+		catchup = getattr(self.config, 'kArchiveCatchup', 0)
+		if limit is not None: catchup = min(catchup, limit)
+		if catchup and time.time() - self.lastSampleTime > kCatchupMinGap:
+			total_rain = None
+			for k in range(kArchiveTries):
+				try:
+					self.SendLOOP()
+					total_rain = self.ReadLOOPResponse().total_rain
+					break
+				except (weather.CommError, serial.TimeoutError), msg:
+					warn("LOOP packet for the archive catch-up:", msg)
+					self.port.flush()
+			if total_rain is None: warn("archive catch-up without the rain total")
+			since = max(self.lastSampleTime, time.time() - catchup)
+			self.CatchUp(self.samples, since, total_rain)
 
 	def GetModelNumber(self):
-		modelno = self.ReadWRD(1, 0, 0x004D)
+		modelno = self.memory.read(1, 0, 0x004D, refresh=1)
 		modelno = ord(modelno)
 
 		try:
@@ -195,92 +710,235 @@ class DataLogger:
 
 		return model, modelno
 		
-	def StartLoop(self):
-#		self.port.flush()
-
+	def Handshake(self):
+		"""Identify the console, check its clock and load the calibration.
+		Returns false if the console did not answer."""
+		self.handshakes = self.handshakes + 1
+		self.memory.invalidate()
 		try:
 			model, modelno = self.GetModelNumber()
 		except serial.TimeoutError, msg:
 			log(msg)
-			return
+			return 0
 			
 		if modelno != 2:
 			raise weather.UnsupportedStationModel, modelno
 
-		self.SetTime(time.time())
+		## after a power cycle or a swap the old readings say nothing
+		## about this clock; read it now rather than trust the prediction
+		self.clock.reset()
+		self.CheckClock(force=1)
 
 ##		self.SetCalibration(0, 0, 100, 0, 0)
 		self.GetCalibration()
 
 		self.SendSTART()
 
-		samples = weather.Samples()
+		self.model = model
+		self.session = 1
+		return 1
+
+	def ProcessSample(self, si, now):
+		samples = self.samples
+
+		samples.addSample(si, now)
+		self.lastSampleTime = now
+
+		samples.CalculateDerivatives(now, si)
+		samples.removeOldSamples(now - weather.kMaxInterval, now)
+
+		## update sample
+		if self.updaters:
+			for updater in self.updaters:
+				updater.update(si)
+
+	def StartLoop(self):
+		"""Run the acquisition loop until a serial error.
+
+		The model, calibration and sample history outlive an error: the
+		next call goes straight back to polling unless it is the
+		kResumeAttempts'th resume in a row without a good sample, in which
+		case the full handshake is repeated.
+		"""
+		attempts = getattr(self.config, 'kResumeAttempts', kResumeAttempts)
+		if self.session and self.resumes < attempts:
+			self.resumes = self.resumes + 1
+			self.failedAt = time.time()
+			log("resuming LOOP polling, attempt", self.resumes)
+			self.port.flush()
+		else:
+			self.session = 0
+			self.resumes = 0
+			self.failedAt = 0
+			if not self.Handshake(): return
+
+		samples = self.samples
+
+		self.CatchUpArchive()
+
+		stream = None
+		if getattr(self.config, 'kLoopStream', 0):
+			stream = LoopStream(self, getattr(self.config, 'kLoopStreamCount', kLoopStreamCount))
+			stream.start()
+
+		sched = self.scheduler
+		if sched is None:
+			sched = weather.Scheduler(self.config.kUpdateInterval,
+																getattr(self.config, 'kSchedulePolicy', weather.kSkip))
+			self.scheduler = sched
+			sched.start()
 
 		while 1:
-			self.SendLOOP()
-
-			now = time.time()
-			si = self.ReadLOOPResponse()
-
-			samples.addSample(si, now)
-
-			samples.CalculateDerivatives(now, si)
-			samples.removeOldSamples(now - weather.kMaxInterval, now)
-
-			## update sample
-			if self.updaters:
-				for updater in self.updaters:
-					updater.update(si)
-
-			weather.time_sleep(self.config.kUpdateInterval)
-
-
-
-crc_table = [
-0x0,  0x1021,  0x2042,  0x3063,  0x4084,  0x50a5,  0x60c6,  0x70e7,  
-0x8108,  0x9129,  0xa14a,  0xb16b,  0xc18c,  0xd1ad,  0xe1ce,  0xf1ef,  
-0x1231,  0x210,  0x3273,  0x2252,  0x52b5,  0x4294,  0x72f7,  0x62d6,  
-0x9339,  0x8318,  0xb37b,  0xa35a,  0xd3bd,  0xc39c,  0xf3ff,  0xe3de,  
-0x2462,  0x3443,  0x420,  0x1401,  0x64e6,  0x74c7,  0x44a4,  0x5485,  
-0xa56a,  0xb54b,  0x8528,  0x9509,  0xe5ee,  0xf5cf,  0xc5ac,  0xd58d,  
-0x3653,  0x2672,  0x1611,  0x630,  0x76d7,  0x66f6,  0x5695,  0x46b4,  
-0xb75b,  0xa77a,  0x9719,  0x8738,  0xf7df,  0xe7fe,  0xd79d,  0xc7bc,  
-0x48c4,  0x58e5,  0x6886,  0x78a7,  0x840,  0x1861,  0x2802,  0x3823,  
-0xc9cc,  0xd9ed,  0xe98e,  0xf9af,  0x8948,  0x9969,  0xa90a,  0xb92b,  
-0x5af5,  0x4ad4,  0x7ab7,  0x6a96,  0x1a71,  0xa50,  0x3a33,  0x2a12,  
-0xdbfd,  0xcbdc,  0xfbbf,  0xeb9e,  0x9b79,  0x8b58,  0xbb3b,  0xab1a,  
-0x6ca6,  0x7c87,  0x4ce4,  0x5cc5,  0x2c22,  0x3c03,  0xc60,  0x1c41,  
-0xedae,  0xfd8f,  0xcdec,  0xddcd,  0xad2a,  0xbd0b,  0x8d68,  0x9d49,  
-0x7e97,  0x6eb6,  0x5ed5,  0x4ef4,  0x3e13,  0x2e32,  0x1e51,  0xe70,  
-0xff9f,  0xefbe,  0xdfdd,  0xcffc,  0xbf1b,  0xaf3a,  0x9f59,  0x8f78,  
-0x9188,  0x81a9,  0xb1ca,  0xa1eb,  0xd10c,  0xc12d,  0xf14e,  0xe16f,  
-0x1080,  0xa1,  0x30c2,  0x20e3,  0x5004,  0x4025,  0x7046,  0x6067,  
-0x83b9,  0x9398,  0xa3fb,  0xb3da,  0xc33d,  0xd31c,  0xe37f,  0xf35e,  
-0x2b1,  0x1290,  0x22f3,  0x32d2,  0x4235,  0x5214,  0x6277,  0x7256,  
-0xb5ea,  0xa5cb,  0x95a8,  0x8589,  0xf56e,  0xe54f,  0xd52c,  0xc50d,  
-0x34e2,  0x24c3,  0x14a0,  0x481,  0x7466,  0x6447,  0x5424,  0x4405,  
-0xa7db,  0xb7fa,  0x8799,  0x97b8,  0xe75f,  0xf77e,  0xc71d,  0xd73c,  
-0x26d3,  0x36f2,  0x691,  0x16b0,  0x6657,  0x7676,  0x4615,  0x5634,  
-0xd94c,  0xc96d,  0xf90e,  0xe92f,  0x99c8,  0x89e9,  0xb98a,  0xa9ab,  
-0x5844,  0x4865,  0x7806,  0x6827,  0x18c0,  0x8e1,  0x3882,  0x28a3,  
-0xcb7d,  0xdb5c,  0xeb3f,  0xfb1e,  0x8bf9,  0x9bd8,  0xabbb,  0xbb9a,  
-0x4a75,  0x5a54,  0x6a37,  0x7a16,  0xaf1,  0x1ad0,  0x2ab3,  0x3a92,  
-0xfd2e,  0xed0f,  0xdd6c,  0xcd4d,  0xbdaa,  0xad8b,  0x9de8,  0x8dc9,  
-0x7c26,  0x6c07,  0x5c64,  0x4c45,  0x3ca2,  0x2c83,  0x1ce0,  0xcc1,  
-0xef1f,  0xff3e,  0xcf5d,  0xdf7c,  0xaf9b,  0xbfba,  0x8fd9,  0x9ff8,  
-0x6e17,  0x7e36,  0x4e55,  0x5e74,  0x2e93,  0x3eb2,  0xed1,  0x1ef0,  
-]
-
-def compute_crc(str):
-	accum = 0L
-	for c in str:
-		accum_high = (accum & 65280) / 256
-		comb_val = int(accum_high) ^ ord(c)
-		crc_tbl = long(crc_table[comb_val])
-		accum_low = (accum & 255) * 256
-		accum = accum_low ^ crc_tbl
-	return int(accum)
-	
+			if stream:
+				s = stream.readLatest()
+				now = time.time()
+				si = self.DecodeLOOP(s)
+			else:
+				self.SendLOOP()
+
+				now = time.time()
+				si = self.ReadLOOPResponse()
+
+			self.ProcessSample(si, now)
+
+			if self.resumes:
+				log("resumed after %.1fs" % (now - self.failedAt))
+				self.resumes = 0
+				self.resumed = self.resumed + 1
+
+			if not stream:
+				self.CheckClock()
+
+			sched.wait()
+			if sched.jitter > self.config.kUpdateInterval / 2.:
+				log("poll late by %.2fs" % sched.jitter, sched.stats(), self.UpdaterStats())
+
+
+
+kLoopHeader = chr(1)
+kLoopStreamCount = 65535
+kStreamBufSize = 4096
+
+class LoopStream:
+	"""Continuous LOOP acquisition.
+
+	One LOOP command asks the console for count packets, which then
+	arrive back to back without any further command/ACK round-trips.
+	Bytes are read in blocks into a fixed bytearray and checked in place
+	for 18 byte frames.  A frame with a bad header or CRC is dropped and
+	the reader realigns on the next 0x01 header instead of failing the
+	session.  The body of the last good frame is copied into self.frame,
+	which is reused for every frame.
+	"""
+	def __init__(self, logger, count=kLoopStreamCount, bufsize=kStreamBufSize):
+		self.logger = logger
+		self.port = logger.port
+		self.count = count
+
+		self.buf = bytearray(bufsize)
+		self.view = memoryview(self.buf)
+		self.pos = 0
+		self.end = 0
+		self.frame = bytearray(17)
+		self.remaining = 0
+
+		self.frames = 0
+		self.resyncs = 0
+
+	def start(self):
+		self.pos = self.end = 0
+		## the only time the console listens to commands
+		self.logger.CheckClock()
+		self.logger.SendLOOP(self.count)
+		self.remaining = self.count
+
+	def fill(self, timed=0):
+		"""Read whatever is waiting on the port into the buffer.  With
+		timed, wait for data and raise if the port has been closed."""
+		if self.pos:
+			live = self.end - self.pos
+			self.buf[0:live] = self.view[self.pos:self.end].tobytes()
+			self.pos = 0
+			self.end = live
+		free = len(self.buf) - self.end
+		if free <= 0:
+			## a full buffer without a single good frame: drop it
+			self.resyncs = self.resyncs + 1
+			self.pos = self.end = 0
+			free = len(self.buf)
+
+		data = self.port.readsome(free, timed)
+		n = len(data)
+		## a timed read that found the port readable but got nothing:
+		## the other end has closed
+		if not n and timed: raise weather.CommError, "port closed"
+		self.buf[self.end:self.end+n] = data
+		self.end = self.end + n
+		return n
+
+	def feed(self, data):
+		n = len(data)
+		if self.end + n > len(self.buf):
+			live = self.end - self.pos
+			self.buf[0:live] = self.view[self.pos:self.end].tobytes()
+			self.pos = 0
+			self.end = live
+			n = min(n, len(self.buf) - live)
+		self.buf[self.end:self.end+n] = data[:n]
+		self.end = self.end + n
+
+	def nextFrame(self):
+		"""Find the next good frame in the buffer and copy its 17 byte body
+		into self.frame.  Returns false if no complete frame is buffered."""
+		buf = self.buf
+		view = self.view
+		pos = self.pos
+		end = self.end
+		while 1:
+			i = buf.find(kLoopHeader, pos, end)
+			if i == -1:
+				if end > pos: self.resyncs = self.resyncs + 1
+				self.pos = self.end = 0
+				return 0
+			if i != pos: self.resyncs = self.resyncs + 1
+
+			if end - i < 18:
+				self.pos = i
+				return 0
+
+			if compute_crc(view[i+1:i+18]):
+				## not a real header, look for the next one
+				self.resyncs = self.resyncs + 1
+				pos = i + 1
+				continue
+
+			self.frame[0:17] = view[i+1:i+18]
+			self.pos = i + 18
+			self.remaining = self.remaining - 1
+			self.frames = self.frames + 1
+			return 1
+
+	def read(self):
+		"""Block until the next good frame arrives."""
+		while not self.nextFrame():
+			if self.remaining <= 0:
+				self.start()
+
+			self.fill(timed=1)
+
+		return self.frame
+
+	def readLatest(self):
+		"""Wait for a frame, then drain anything else already received and
+		return the most recent good frame."""
+		self.read()
+		## one fill() may have brought in every frame sent since the last
+		## call; read() only took the oldest of them
+		while self.nextFrame(): pass
+		while self.fill():
+			while self.nextFrame(): pass
+
+		return self.frame
 
 
 def GetSerialConfig(pConfig):
@@ -289,5 +947,83 @@ def GetSerialConfig(pConfig):
 	cfg.set(pConfig.kCommPort, serial.Baud2400, 
 					serial.WordLength8, serial.NoParity, serial.OneStopBit, 5000)
 	return cfg
-	
 
+
+
+def bench(n=20000):
+	"""Compare frames decoded per second by the old per-frame path
+	(slice, struct.unpack with a format string, new SensorImage) and the
+	precompiled Struct decoding into a new SensorImage.
+	Both sides read every field the old path filled in, dewpoint
+	included."""
+	import crc16
+	frame = crc16.make_frame(struct.pack('<hhBhhBBhh', 705, 512, 4, 225, 29530, 41, 63, 120, 0))
+	blob = frame * 64
+	buf = bytearray(blob)
+
+	dl = DataLogger(None, None)
+	dl.windcal = 1600
+
+	def old(s):
+		rec = struct.unpack('<hhBhhBBhhh', s)
+		si = weather.SensorImage()
+		si.sample_time = time.time()
+		si.inside_temp = (rec[0] + dl.tp1cal) / 10.
+		si.outside_temp = (rec[1] + dl.tp2cal) / 10.
+		si.wind_speed = (rec[2] * 1600.) / dl.windcal
+		si.wind_direction = rec[3]
+		si.barometer = (rec[4] + 370) / 1000.
+		seabarometer = si.barometer
+		si.inside_humidity = rec[5] + dl.hm1cal
+		si.outside_humidity = rec[6] + dl.hm2cal
+		if si.outside_humidity > 100: si.outside_humidity = 100
+		si.total_rain = rec[7] / (1.0 * dl.rncal)
+		dewpoint = weather_util.DewCalc(si.outside_humidity, si.outside_temp)
+		return (si.inside_temp, si.outside_temp, si.wind_speed, si.wind_direction,
+						si.barometer, seabarometer, si.inside_humidity,
+						si.outside_humidity, si.total_rain, dewpoint)
+
+	def fields(si):
+		return (si.inside_temp, si.outside_temp, si.wind_speed, si.wind_direction,
+						si.barometer, si.seabarometer, si.inside_humidity,
+						si.outside_humidity, si.total_rain, si.dewpoint)
+
+	t1 = time.time()
+	for i in xrange(n):
+		off = (i & 63) * 18
+		old(blob[off+1:off+18])
+	t2 = time.time()
+	before = n / (t2 - t1)
+
+	t1 = time.time()
+	for i in xrange(n):
+		si = weather.SensorImage()
+		dl.ParseLoopResponse(si, buf, (i & 63) * 18 + 1)
+		fields(si)
+	t2 = time.time()
+	after = n / (t2 - t1)
+
+	warn("LOOP decode: before %d frames/s, after %d frames/s (%.1fx)" % (before, after, after / before))
+	return before, after
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help", "bench"])
+
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+		if field == "--bench":
+			bench()
+			return
+	usage(progname)
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
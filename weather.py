@@ -12,17 +12,33 @@ usage: %(progname)s [args]
 """
 _version = "pyweather 0.1"
 
-import os, sys, string, time, getopt, urllib
+import os, sys, string, time, getopt, bisect, collections, array, threading
 from log import *
 
+## numpy for Samples.aggregate(), imported the first time it is needed:
+## 0 until then, None when it is not installed
+_numpy = 0
+
+def numpyModule():
+	global _numpy
+	if _numpy == 0:
+		try:
+			import numpy
+			_numpy = numpy
+		except ImportError:
+			_numpy = None
+	return _numpy
+
 
 import serial
 import weather_util
+import recordfile
+import rain
 
 ## exceptions
-NoSuchWeatherStation = "No Such Weather Station"
-UnsupportedStationModel = "Unsupported Station Model"
-CommError = "Communication Error"
+class NoSuchWeatherStation(Exception): pass
+class UnsupportedStationModel(Exception): pass
+class CommError(Exception): pass
 
 
 ## constant
@@ -35,8 +51,6 @@ kBaroInterval = 3600
 kRainInterval = 3600
 kWindInterval = 3600
 
-kMaxInterval = max(kRainInterval, kBaroInterval, kWindInterval)
-
 import config
 try:
 	import site_config
@@ -45,26 +59,479 @@ except ImportError:
 	pass
 
 
+## Rolling aggregates set on every SensorImage: (name, field, kind, window).
+## kind is one of kWindowKinds over the last window seconds, or
+## "since_midnight" for the change in field since local midnight.
+## config.kAggregates adds to these.
+kDefaultAggregates = [
+	('baro_diff', 'barometer', 'delta', kBaroInterval),
+	('max_wind_speed', 'wind_speed', 'max', kWindInterval),
+	('min_wind_speed', 'wind_speed', 'min', kWindInterval),
+	('max_outside_temp', 'outside_temp', 'max', kWindInterval),
+	('min_outside_temp', 'outside_temp', 'min', kWindInterval),
+	('max_outside_humidity', 'outside_humidity', 'max', kWindInterval),
+	('min_outside_humidity', 'outside_humidity', 'min', kWindInterval),
+	]
+
+kWindowKinds = ['max', 'min', 'mean', 'sum', 'count', 'delta']
+kSinceMidnight = 'since_midnight'
+
+kAggregates = kDefaultAggregates + list(getattr(config, 'kAggregates', []))
+
+## how much history Samples keeps
+kMaxInterval = max([window for (name, field, kind, window) in kAggregates])
+
+
 time_sleep = time.sleep
 
 
+## what the Scheduler does after a cycle overran its deadline
+kSkip = "skip"					## drop the missed ticks, stay on the grid
+kCatchUp = "catchup"		## run the missed ticks back to back
+
+class Scheduler:
+	"""Paces a loop on absolute deadlines start + k * interval.
+
+	Deadlines come from a monotonic clock, so the time spent doing the
+	work does not push the following cycles back and setting the wall
+	clock does not disturb the cadence.  Jitter (how late each wake-up
+	was) and overruns are counted for stats().
+	"""
+	def __init__(self, interval, policy=kSkip, clock=None):
+		if clock is None: clock = weather_util.monotonic
+		self.interval = interval
+		self.policy = policy
+		self.clock = clock
+		self.deadline = None
+
+		self.ticks = 0
+		self.overruns = 0
+		self.skipped = 0
+		self.jitter = 0.0
+		self.max_jitter = 0.0
+		self.total_jitter = 0.0
+
+	def start(self):
+		self.deadline = self.clock()
+
+	def wait(self):
+		"""Sleep until the next deadline."""
+		if self.deadline is None: self.start()
+		self.deadline = self.deadline + self.interval
+
+		now = self.clock()
+		if now > self.deadline:
+			self.overruns = self.overruns + 1
+			if self.policy == kSkip:
+				missed = int((now - self.deadline) / self.interval) + 1
+				self.skipped = self.skipped + missed
+				self.deadline = self.deadline + missed * self.interval
+			else:
+				self._tick(now)
+				return
+
+		delay = self.deadline - self.clock()
+		if delay > 0: time_sleep(delay)
+		self._tick(self.clock())
+
+	def _tick(self, now):
+		self.ticks = self.ticks + 1
+		self.jitter = now - self.deadline
+		self.total_jitter = self.total_jitter + abs(self.jitter)
+		if abs(self.jitter) > self.max_jitter: self.max_jitter = abs(self.jitter)
+
+	def stats(self):
+		mean = 0.0
+		if self.ticks: mean = self.total_jitter / self.ticks
+		return {'ticks': self.ticks, 'overruns': self.overruns,
+						'skipped': self.skipped, 'jitter': self.jitter,
+						'mean_jitter': mean, 'max_jitter': self.max_jitter}
+
+
+## columns filled in by CalculateDerivatives after the sample is added
+kDerivedFields = rain.kFields + [name for (name, field, kind, window) in kAggregates]
+
+## columns kept by Samples for every sample
+kSampleFields = ['inside_temp', 'outside_temp', 'basement_temp',
+								 'wind_speed', 'wind_gust_speed', 'wind_direction',
+								 'barometer',
+								 'inside_humidity', 'outside_humidity', 'basement_humidity',
+								 'total_rain', 'lowbat'] + kDerivedFields
+
+## stored in place of None
+kMissing = float('nan')
+
+
+class WindowStat:
+	"""max, min, mean and count of one field over a sliding time window.
+
+	The max and min are the heads of two monotonic deques and the mean
+	is a running sum, so adding and expiring samples is O(1) amortized.
+	Samples have to be added in time order.
+	"""
+	def __init__(self, field, window):
+		self.field = field
+		self.window = window
+
+		self.items = collections.deque()
+		self.maxq = collections.deque()
+		self.minq = collections.deque()
+		self.sum = 0.0
+
+	def clear(self):
+		self.items.clear()
+		self.maxq.clear()
+		self.minq.clear()
+		self.sum = 0.0
+
+	def add(self, t, v):
+		if v is None: return
+		maxq = self.maxq
+		while maxq and maxq[-1][1] <= v: maxq.pop()
+		maxq.append((t, v))
+
+		minq = self.minq
+		while minq and minq[-1][1] >= v: minq.pop()
+		minq.append((t, v))
+
+		self.items.append((t, v))
+		self.sum = self.sum + v
+
+		self.expire(t)
+
+	def expire(self, now):
+		t1 = now - self.window
+		items = self.items
+		while items and items[0][0] < t1:
+			self.sum = self.sum - items.popleft()[1]
+		while self.maxq and self.maxq[0][0] < t1: self.maxq.popleft()
+		while self.minq and self.minq[0][0] < t1: self.minq.popleft()
+
+	def max(self):
+		if not self.maxq: return None
+		return self.maxq[0][1]
+
+	def min(self):
+		if not self.minq: return None
+		return self.minq[0][1]
+
+	def count(self):
+		return len(self.items)
+
+	def mean(self):
+		if not self.items: return None
+		return self.sum / len(self.items)
+
+	def delta(self):
+		"""newest minus oldest value, once the window is at least 3/4 full"""
+		items = self.items
+		if not items: return None
+		if items[-1][0] - items[0][0] < self.window * .75: return None
+		return items[-1][1] - items[0][1]
+
+	def value(self, kind):
+		if kind == 'max': return self.max()
+		if kind == 'min': return self.min()
+		if kind == 'mean': return self.mean()
+		if kind == 'sum': return self.sum
+		if kind == 'count': return self.count()
+		if kind == 'delta': return self.delta()
+		raise ValueError, "unknown aggregate %s" % kind
+
+
+class DailyStat:
+	"""Change in one field since local midnight, measured from the last
+	value of the previous day (or the first of today if there is none)."""
+	def __init__(self, field):
+		self.field = field
+		self.clear()
+
+	def clear(self):
+		self.day = None
+		self.base = None
+		self.last = None
+		self.lastTime = None
+
+	def add(self, t, v):
+		if v is None: return
+		if self.lastTime is not None and t < self.lastTime: return
+		day = time.localtime(t)[:3]
+		if day != self.day:
+			self.day = day
+			if self.last is None: self.base = v
+			else: self.base = self.last
+		self.last = v
+		self.lastTime = t
+
+	def value(self, kind):
+		if self.last is None: return None
+		return self.last - self.base
+
+
+class WindowStats:
+	"""A set of WindowStats keyed by (field, window)."""
+	def __init__(self):
+		self.windows = {}
+
+	def track(self, field, window):
+		key = (field, window)
+		if not self.windows.has_key(key):
+			self.windows[key] = WindowStat(field, window)
+		return self.windows[key]
+
+	def get(self, field, window):
+		return self.windows[(field, window)]
+
+	def add(self, t, sample):
+		for w in self.windows.values():
+			w.add(t, getattr(sample, w.field))
+
+	def expire(self, now):
+		for w in self.windows.values():
+			w.expire(now)
+
+	def rebuild(self, samples, end=None):
+		"""Start over from the samples in the window, up to row end; needed
+		when a sample arrives out of order."""
+		for w in self.windows.values():
+			w.clear()
+		times = samples.times
+		if end is None: end = len(times)
+		for w in self.windows.values():
+			col = samples.columns[w.field]
+			for i in xrange(samples.head, end):
+				v = col[i]
+				if v == v: w.add(times[i], v)
+
+
+class Aggregates:
+	"""The rolling aggregates in a list like kAggregates.
+
+	Aggregates of the same field and window share one WindowStat, so each
+	sample is folded in once per (field, window) however many aggregates
+	are read from it, and nothing walks the history.
+	"""
+	def __init__(self, aggregates):
+		self.stats = WindowStats()
+		self.daily = {}
+		self.entries = []
+		for (name, field, kind, window) in aggregates:
+			if kind == kSinceMidnight:
+				if not self.daily.has_key(field):
+					self.daily[field] = DailyStat(field)
+				stat = self.daily[field]
+			elif kind in kWindowKinds:
+				stat = self.stats.track(field, window)
+			else:
+				raise ValueError, "unknown aggregate %s for %s" % (kind, name)
+			self.entries.append((name, kind, stat))
+
+	def add(self, t, sample):
+		self.stats.add(t, sample)
+		for d in self.daily.values():
+			d.add(t, getattr(sample, d.field))
+
+	def addRow(self, samples, i):
+		"""add row i of samples"""
+		t = samples.times[i]
+		columns = samples.columns
+		for w in self.stats.windows.values():
+			v = columns[w.field][i]
+			if v == v: w.add(t, v)
+		for d in self.daily.values():
+			v = columns[d.field][i]
+			if v == v: d.add(t, v)
+
+	def rebuild(self, samples, end=None):
+		self.stats.rebuild(samples, end)
+		times = samples.times
+		if end is None: end = len(times)
+		for d in self.daily.values():
+			d.clear()
+			col = samples.columns[d.field]
+			for i in xrange(samples.head, end):
+				v = col[i]
+				if v == v: d.add(times[i], v)
+
+	def compute(self, now, si):
+		"""set every aggregate as an attribute of si"""
+		self.stats.expire(now)
+		for (name, kind, stat) in self.entries:
+			v = stat.value(kind)
+			if v is not None: setattr(si, name, v)
+
+	def computeRow(self, now, samples, i):
+		"""store every aggregate in row i of samples"""
+		self.stats.expire(now)
+		columns = samples.columns
+		for (name, kind, stat) in self.entries:
+			v = stat.value(kind)
+			if v is not None: columns[name][i] = v
+
+
 class Samples:
+	"""Time-ordered window of sensor samples, stored by column.
+
+	Every field in kSampleFields has its own array of doubles next to
+	the timestamp column, so a sample costs 8 bytes per field instead of
+	a SensorImage instance.  SensorImages are rebuilt from a row when
+	one is looked up.  Rows before self.head have been evicted; the
+	columns are compacted once the dead prefix is as long as the live
+	part, so eviction is O(1) amortized and lookups are a bisect.
+	"""
 	def __init__(self):
-		self.samples = []
+		self.times = array.array('d')
+		self.columns = {}
+		for field in kSampleFields:
+			self.columns[field] = array.array('d')
+		self.head = 0
+
+		self.aggregates = Aggregates(kAggregates)
+		self.store = None
+		self.rollups = None
+		self.rain = rain.RainAccumulator(diffWindow=kRainInterval)
+
+	def __len__(self):
+		return len(self.times) - self.head
 
 	def addSample(self, sample, t):
-		self.samples.append((t, sample))
-		self.samples.sort()
+		times = self.times
+		columns = self.columns
+		if not times or t >= times[-1]:
+			times.append(t)
+			for field in kSampleFields:
+				v = getattr(sample, field)
+				if v is None: v = kMissing
+				columns[field].append(v)
+			self.aggregates.add(t, sample)
+		else:
+			i = bisect.bisect_right(times, t, self.head)
+			times.insert(i, t)
+			for field in kSampleFields:
+				v = getattr(sample, field)
+				if v is None: v = kMissing
+				columns[field].insert(i, v)
+			self.aggregates.rebuild(self)
+
+		if self.store is not None: self.store.append(t, sample)
+
+	def _appendRow(self, times, columns, t, sample):
+		times.append(t)
+		for field in kSampleFields:
+			v = getattr(sample, field)
+			if v is None: v = kMissing
+			columns[field].append(v)
+
+	def addSamples(self, items):
+		"""Add a batch of (t, SensorImage) and calculate their derivatives.
+
+		The batch is sorted (linear when it already is) and appended, or
+		merged with the window in one pass when it overlaps it.  Then the
+		aggregates are run forward once from the first new row, so a batch
+		costs O(n) instead of an insert and a derivative pass per sample.
+		Returns the number of samples added.
+		"""
+		batch = list(items)
+		batch.sort(key=lambda item: item[0])
+		if not batch: return 0
+
+		times = self.times
+		columns = self.columns
+		if not times or batch[0][0] >= times[-1]:
+			first = len(times)
+			for (t, si) in batch:
+				self._appendRow(times, columns, t, si)
+			fresh = [si for (t, si) in batch]
+		else:
+			## merge the rows from the first one after the batch starts
+			first = bisect.bisect_right(times, batch[0][0], self.head)
+			newtimes = times[:first]
+			newcolumns = {}
+			for field in kSampleFields:
+				newcolumns[field] = columns[field][:first]
+			fresh = []
+			i = first
+			n = len(times)
+			for (t, si) in batch:
+				while i < n and times[i] <= t:
+					newtimes.append(times[i])
+					for field in kSampleFields:
+						newcolumns[field].append(columns[field][i])
+					fresh.append(None)
+					i = i + 1
+				self._appendRow(newtimes, newcolumns, t, si)
+				fresh.append(si)
+			for k in xrange(i, n):
+				newtimes.append(times[k])
+				for field in kSampleFields:
+					newcolumns[field].append(columns[field][k])
+				fresh.append(None)
+			self.times = times = newtimes
+			self.columns = columns = newcolumns
+			self.aggregates.rebuild(self, first)
+
+		## derivatives for every row from first on
+		aggregates = self.aggregates
+		rains = []
+		for k in xrange(first, len(times)):
+			t = times[k]
+			aggregates.addRow(self, k)
+			si = fresh[k - first]
+			if si is None:
+				aggregates.computeRow(t, self, k)
+				continue
+			aggregates.compute(t, si)
+			rains.append(self.rain.add(t, si))
+			for field in kDerivedFields:
+				v = getattr(si, field)
+				if v is None: v = kMissing
+				columns[field][k] = v
+
+		i = 0
+		for (t, si) in batch:
+			if self.store is not None: self.store.append(t, si)
+			if self.rollups is not None: self.rollups.add(t, si, rains[i])
+			i = i + 1
+		return len(batch)
+
+	def attach(self, store, now):
+		"""Reload the window up to now from a SampleStore, then append
+		every new sample to it."""
+		self.store = None
+		n = self.addSamples(store.samples(now - kMaxInterval, now))
+		self.store = store
+		if n: log("reloaded", n, "samples from", store.file.path)
+
+	def attachRollups(self, rollups, now):
+		"""Feed every new sample to a rollup.Rollups, after refilling its
+		open summaries from the store."""
+		if self.store is not None:
+			rollups.resume(self.store.samples(rollups.resumeFrom(now), now), self.rain.wrap)
+		self.rollups = rollups
+
+	def sample(self, i, si=None):
+		"""The row at index i as a SensorImage."""
+		if si is None: si = SensorImage()
+		si.sample_time = self.times[i]
+		columns = self.columns
+		for field in kSampleFields:
+			v = columns[field][i]
+			if v != v: v = None
+			setattr(si, field, v)
+		return si
+
+	def findIndex(self, t):
+		"""index of the sample closest to t"""
+		times = self.times
+		i = bisect.bisect_left(times, t, self.head)
+		if i == len(times) or (i > self.head and t - times[i-1] <= times[i] - t):
+			i = i - 1
+		if i < self.head: raise IndexError, "no samples"
+		return i
 
 	def findSample(self, t):
-		ret = []
-		for (t2, sample) in self.samples:
-			ret.append((abs(t-t2), sample))
-			
-		ret.sort()
-
-		diff, sample = ret[0]
-		return diff, sample
+		i = self.findIndex(t)
+		return abs(t - self.times[i]), self.sample(i)
 			
 
 	def getDiff(self, t, interval):
@@ -76,87 +543,187 @@ class Samples:
 		return last_sample
 		
 	def removeOldSamples(self, t1, t2):
-		self.samples = self.getSamples(t1, t2)
+		times = self.times
+		columns = self.columns.values()
+
+		self.head = bisect.bisect_left(times, t1, self.head)
+
+		j = bisect.bisect_right(times, t2, self.head)
+		if j < len(times):
+			del times[j:]
+			for col in columns:
+				del col[j:]
+
+		if self.head and self.head >= len(times) - self.head:
+			del times[:self.head]
+			for col in columns:
+				del col[:self.head]
+			self.head = 0
 		return
 
+	def indexRange(self, t1, t2):
+		"""(i, j) such that rows i..j-1 are the samples from t1 to t2"""
+		times = self.times
+		i = bisect.bisect_left(times, t1, self.head)
+		j = bisect.bisect_right(times, t2, self.head)
+		return i, j
 
 	def getSamples(self, t1, t2):
-		new_samples = []
-		for (t, sample) in self.samples:
-			if t >= t1 and t <= t2: new_samples.append((t, sample))
-		
-		return new_samples
+		i, j = self.indexRange(t1, t2)
+		ret = []
+		for k in xrange(i, j):
+			ret.append((self.times[k], self.sample(k)))
+		return ret
+
+	def column(self, field, t1, t2):
+		"""copy of one field from t1 to t2 as an array"""
+		i, j = self.indexRange(t1, t2)
+		return self.columns[field][i:j]
+
+	def aggregate(self, field, t1, t2, how):
+		"""max, min, mean, sum or count of one field from t1 to t2, with
+		missing values left out.  Runs over the column in place with
+		numpy when it is installed."""
+		i, j = self.indexRange(t1, t2)
+		col = self.columns[field]
+
+		numpy = numpyModule()
+		if numpy is not None:
+			values = numpy.frombuffer(col, numpy.float64, j - i, i * col.itemsize)
+			values = values[~numpy.isnan(values)]
+			if how == 'count': return len(values)
+			if not len(values): return None
+			if how == 'sum': return float(values.sum())
+			if how == 'mean': return float(values.mean())
+			if how == 'max': return float(values.max())
+			if how == 'min': return float(values.min())
+			raise ValueError, "unknown aggregate %s" % how
+
+		values = filter(lambda v: v == v, col[i:j])
+		if how == 'count': return len(values)
+		if not values: return None
+		if how == 'sum': return sum(values)
+		if how == 'mean': return sum(values) / len(values)
+		if how == 'max': return max(values)
+		if how == 'min': return min(values)
+		raise ValueError, "unknown aggregate %s" % how
 
 
 	def CalculateDerivatives(self, now, si):
-		## calculate derivatives
-		sample = self.getDiff(now-kRainInterval, kRainInterval)
-		if sample:
-			si.rain_diff = si.total_rain - sample.total_rain
-
-		sample = self.getDiff(now-kBaroInterval, kBaroInterval)
-		if sample:
-			si.baro_diff = si.barometer - sample.barometer
-
-		## calc max/min wind speed
-		wind_samples = self.getSamples(now - kWindInterval, now)
-		wind_speed = []
-		outside_temp = []
-		outside_humidity = []
-
-		for (t, sample) in wind_samples:
-			wind_speed.append(sample.wind_speed)
-			outside_temp.append(sample.outside_humidity)
-			outside_humidity.append(sample.outside_temp)
-		wind_speed.sort()
-		outside_temp.sort()
-		outside_humidity.sort()
-
-		si.max_wind_speed = wind_speed[-1]
-		si.min_wind_speed = wind_speed[0]
-
-		si.max_outside_temp = outside_temp[-1]
-		si.min_outside_temp = outside_temp[0]
-
-		si.max_outside_humidity = outside_humidity[-1]
-		si.min_outside_humidity = outside_humidity[0]
-
-
+		## rolling aggregates, kept up to date by addSample
+		self.aggregates.compute(now, si)
+		rain = self.rain.add(now, si)
+		if self.rollups is not None: self.rollups.add(now, si, rain)
+
+		## the row was stored before these were known
+		i = self.findIndex(now)
+		if self.times[i] == now:
+			columns = self.columns
+			for field in kDerivedFields:
+				v = getattr(si, field)
+				if v is None: v = kMissing
+				columns[field][i] = v
+
+
+
+## sample fields written to the SampleStore
+kStoreFields = [field for field in kSampleFields if field not in kDerivedFields]
+
+## seconds between fsync()s of the SampleStore
+kSampleStoreSync = 60
+
+class SampleStore:
+	"""Every sample, kept on disk as a record of kStoreFields in a
+	RecordFile.  The aggregates are not stored; they are worked out again
+	when the samples are reloaded."""
+	def __init__(self, path, syncInterval=kSampleStoreSync):
+		self.file = recordfile.RecordFile(path, '<d' + 'd' * len(kStoreFields),
+																			['time'] + kStoreFields, syncInterval)
+
+	def append(self, t, si):
+		rec = [t]
+		for field in kStoreFields:
+			v = getattr(si, field)
+			if v is None: v = kMissing
+			rec.append(v)
+		return self.file.append(rec)
+
+	def samples(self, t1, t2):
+		"""(t, SensorImage) for every stored sample from t1 to t2"""
+		for rec in self.file.records(t1, t2):
+			si = SensorImage()
+			si.sample_time = rec[0]
+			i = 1
+			for field in kStoreFields:
+				v = rec[i]
+				if v != v: v = None
+				setattr(si, field, v)
+				i = i + 1
+			yield rec[0], si
+
+	def sync(self):
+		self.file.sync()
+
+	def close(self):
+		self.file.close()
+
+
+## SensorImage fields set from the station's record: (name, value
+## until a station sets it)
+kSensorFields = [
+	('inside_temp', 0.0),
+	('outside_temp', 0.0),
+	('basement_temp', 0.0),
+	('wind_speed', 0.0),
+	('wind_gust_speed', 0.0),
+	('wind_direction', 0),
+	('barometer', 0.0),
+	('inside_humidity', 0.0),
+	('outside_humidity', 0.0),
+	('basement_humidity', 0.0),
+	('total_rain', 0.0),
+	('lowbat', 0),
+	]
+
+## worked out from the sensor fields each time they are read; only the
+## sinks read them, and not on every sample
+kComputedFields = [
+	('seabarometer', lambda si: si.barometer),
+	('dewpoint', lambda si: weather_util.DewCalc(si.outside_humidity, si.outside_temp)),
+
+	('inside_temp_c', lambda si: weather_util.Fahrenheit2Celsius(si.inside_temp)),
+	('outside_temp_c', lambda si: weather_util.Fahrenheit2Celsius(si.outside_temp)),
+	('dewpoint_c', lambda si: weather_util.Fahrenheit2Celsius(si.dewpoint)),
+	('barometer_mb', lambda si: weather_util.Inches2Millibars(si.barometer)),
+	('seabarometer_mb', lambda si: weather_util.Inches2Millibars(si.seabarometer)),
+	('wind_speed_ms', lambda si: weather_util.MilesPerHour2MetersPerSecond(si.wind_speed)),
+	('wind_gust_speed_ms', lambda si: weather_util.MilesPerHour2MetersPerSecond(si.wind_gust_speed)),
+	]
+
+
+class SensorImage(object):
+	"""One sample.
+
+	The sensor values are plain slots that the station fills in.  The
+	dewpoint and the metric conversions are computed when something
+	reads them, see kComputedFields.
+	"""
+	__slots__ = ['sample_time'] + [name for (name, value) in kSensorFields] + kDerivedFields
 
-class SensorImage:
 	def __init__(self):
-		self.sample_time = 0
-
-		self.inside_temp = 0.0
-		self.outside_temp = 0.0
-		self.basement_temp = 0.0
-		self.wind_speed = 0.0
-		self.wind_gust_speed = 0.0
-		self.wind_direction = 0
-		self.barometer = 0.0
-		self.seabarometer = 0.0
-		self.inside_humidity = 0.0
-		self.outside_humidity = 0.0
-		self.basement_humidity = 0.0
-		self.total_rain = 0.0
+		self.reset()
 
-		self.dewpoint = 0.0
+	def reset(self):
+		for (name, value) in kSensorFields:
+			setattr(self, name, value)
+		for name in kDerivedFields:
+			setattr(self, name, None)
 
-		self.lowbat = 0
+		self.sample_time = 0
 
 		self.rain_diff = 0
 		self.baro_diff = 0
 
-		self.max_wind_speed = None
-		self.min_wind_speed = None
-
-		self.max_outside_temp = None
-		self.min_outside_temp = None
-
-		self.max_outside_humidity = None
-		self.min_outside_humidity = None
-		
-		
 	def display(self):
 		s = "itemp: %.1f otemp: %.1f wind: %s@%s baro:%.3f ihum: %s%% ohum: %s%%  rain: %.2f\ndewpoint: %.2f" % (self.inside_temp, self.outside_temp, self.wind_speed, self.wind_direction, self.barometer, self.inside_humidity, self.outside_humidity, self.total_rain, self.dewpoint)
 		return s
@@ -176,196 +743,343 @@ class SensorImage:
 #		log("               Rain: %.2f (in)" % self.rain_diff)
 #		log("         Total Rain: %.2f (in)" % self.total_rain)
 #		log("-")
+
+for (name, compute) in kComputedFields:
+	setattr(SensorImage, name, property(compute))
+
 		
+## what an AsyncUpdater does with a sample when its queue is full
+kDropOldest = "drop-oldest"		## drop the oldest queued sample
+kConflate = "conflate"				## replace the queued update, only the latest matters
+kBlock = "block"							## wait for the worker to make room
+
+kUpdaterQueue = 16
+
 class Updater:
+	## overflow policy when run behind an AsyncUpdater; None for the default
+	queuePolicy = None
+
+	## backfill() is quick and thread safe, so an AsyncUpdater calls it
+	## straight away instead of queueing the sample
+	inlineBackfill = 0
+
 	def __init__(self, config, updateInterval=10):
 		self.config = config
 		self.lastupdate = 0
 		self.updateInterval = updateInterval
 
 	def update(self, sensor):
+		if self.due():
+			self._update(sensor)
+
+	def due(self):
 		now = time.time()
 		
 		if self.lastupdate + self.updateInterval <= now:
 			self.lastupdate = now
-			self._update(sensor)
-
-class ShellUpdate(Updater):
-	def _update(self, sensor):
-		sensor.Display()
-
-class CSVUpdate(Updater):
-	def _update(self, sensor):
-		t = time.localtime(sensor.sample_time)
-		
-		line = [t[0], t[1], t[2], t[3], t[4], t[5]]
-		line.append(sensor.wind_speed)
-		line.append(sensor.wind_gust_speed)
-		line.append(sensor.wind_direction)
-		line.append(sensor.inside_humidity)
-		line.append(sensor.outside_humidity)
-		line.append(sensor.inside_temp)
-		line.append(sensor.outside_temp)
-		line.append(sensor.barometer)
-		line.append(sensor.total_rain)
-		line.append(sensor.total_rain)
-		line.append(sensor.rain_diff)
-		line.append(sensor.basement_temp)
-		line.append(sensor.basement_humidity)
-		line.append(0)
-		
-		if os.path.isfile(config.kCSVFile):
-			fp = open(self.config.kCSVFile)
-			lines = fp.readlines()
-			fp.close()
-			if len(lines) >= config.kCSV_MaxLines:
-				st = len(lines) - config.kCSV_MaxLines + 1
-				fp = open(config.kCSVFile, "w")
-				fp.writelines(lines[st:])
-				fp.close()
-
-		if os.path.isfile(config.kCSVFile):
-			fp = open(self.config.kCSVFile, "a")
-		else:
-			fp = open(self.config.kCSVFile, "w")
-		sline = []
-		for num in line: sline.append(str(num))
-		fp.write(string.join(sline, ","))
-		fp.write(os.linesep)
-		fp.close()
-		
-		
-class Wunderground(Updater):
+			return 1
+		return 0
+
+	def backfill(self, sensor):
+		"""called with samples recovered after an outage, oldest first"""
+		pass
+
+	def start(self):
+		"""called once the updater has been added to the DataLogger"""
+		pass
+
+
+class AsyncUpdater:
+	"""Runs an Updater on its own worker thread behind a bounded queue, so
+	a slow sink never holds up acquisition.
+
+	update() checks the interval on the caller's thread and only queues
+	the samples that are due.  When the queue is full the policy decides:
+	kDropOldest, kConflate (an update replaces the queued one; backfills
+	are never conflated) or kBlock.  Backfills are only queued for an
+	Updater that overrides backfill().  stats() has the queue depth and
+	how long the last sample waited (lag).
+	"""
+	def __init__(self, updater, maxsize=kUpdaterQueue, policy=kDropOldest):
+		self.updater = updater
+		self.name = updater.__class__.__name__
+		self.maxsize = maxsize
+		self.policy = policy
+		self.backfills = updater.__class__.backfill.im_func is not Updater.backfill.im_func
+
+		self.queue = collections.deque()
+		self.cond = threading.Condition()
+
+		self.queued = 0
+		self.done = 0
+		self.dropped = 0
+		self.conflated = 0
+		self.errors = 0
+		self.lag = 0.0
+		self.max_lag = 0.0
+
+		self.thread = threading.Thread(target=self._run, name="updater-" + self.name)
+		self.thread.setDaemon(1)
+		self.thread.start()
 
-	def _update(self, sensor):
-		if self.config.kWundergroundUserID == 'userid': return
-
-		if sensor.sample_time == 0: 
-			warn("sample_time is zero")
-			return
-
-		utc = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(sensor.sample_time))
-
-		host = "weatherstation.wunderground.com"
-		port = 80
-		inside_cond = "Inside=%.1f/%s%%" % (sensor.inside_temp, sensor.inside_humidity)
-
-		path = "/weatherstation/updateweatherstation.php?ID=%s&PASSWORD=%s&dateutc=%s&winddir=%s&windspeedmph=%s&windgustmph=%s&tempf=%.1f&rainin=%.2f&baromin=%.2f&dewptf=%.2f&humidity=%s&indoortempf=%.1f&indoorhumidity=%s&softwaretype=%s&action=updateraw" % (urllib.quote(self.config.kWundergroundUserID), urllib.quote(self.config.kWundergroundPassword), urllib.quote(utc), sensor.wind_direction, sensor.wind_speed, sensor.max_wind_speed, sensor.outside_temp, sensor.rain_diff, sensor.barometer, sensor.dewpoint, sensor.outside_humidity, sensor.inside_temp, sensor.inside_humidity, urllib.quote(_version))
-
-		url = "http://" + host + path
-
-		if 1:
-			try:  
-#				sleep_time = (((time.localtime(time.time())[4] / config.kWunderground_UpdateInterval) + 1) * config.kWunderground_UpdateInterval);
-#				if sleep_time > 59: sleep_time = 60 - time.localtime(time.time())[4];
-#				else: sleep_time = sleep_time - time.localtime(time.time())[4];
-#				sleep_seconds = time.localtime(time.time())[5];
-#				sleep_time = (sleep_time * 60) - sleep_seconds;
-#				m, s = divmod(sleep_time, 60);
-#				log("uploading to Wunderground.com.  Next update in: " + str(m) + ":" + str(s));
-				log("uploading to Wunderground.com.");
-
-				if 1:
-					import fhttplib
-					h = fhttplib.aHTTP (host, port, timeout=10)
-
-					h.putrequest("GET", path)
-					h.putheader("Host", host)
-					h.endheaders()
-
-					errcode, errmsg, headers = h.getreply()
-
-					f = h.getfile()
-					page = f.read()
-					f.close()
-
-				if 0:
-					fp = urllib.urlopen(url)
-					page = fp.read()
-					fp.close()
+	def update(self, sensor):
+		if self.updater.due():
+			self.put('update', sensor)
+
+	def backfill(self, sensor):
+		if not self.backfills: return
+		if self.updater.inlineBackfill: self.updater.backfill(sensor)
+		else: self.put('backfill', sensor)
+
+	def put(self, kind, sensor):
+		cond = self.cond
+		cond.acquire()
+		try:
+			queue = self.queue
+			if kind == 'update' and self.policy == kConflate:
+				## the newer sample goes to the back, behind any backfill
+				for i in range(len(queue) - 1, -1, -1):
+					if queue[i][0] == 'update':
+						del queue[i]
+						self.conflated = self.conflated + 1
+						break
+			while len(queue) >= self.maxsize:
+				if self.policy == kBlock:
+					cond.wait()
+				else:
+					queue.popleft()
+					self.dropped = self.dropped + 1
+			queue.append((kind, sensor, time.time()))
+			self.queued = self.queued + 1
+			cond.notifyAll()
+		finally:
+			cond.release()
+
+	def _run(self):
+		cond = self.cond
+		while 1:
+			cond.acquire()
+			try:
+				while not self.queue: cond.wait()
+				kind, sensor, queuedAt = self.queue.popleft()
+				cond.notifyAll()
+			finally:
+				cond.release()
+
+			self.lag = time.time() - queuedAt
+			if self.lag > self.max_lag: self.max_lag = self.lag
+			try:
+				if kind == 'update': self.updater._update(sensor)
+				else: self.updater.backfill(sensor)
 			except:
+				self.errors = self.errors + 1
 				import traceback
 				traceback.print_exc()
+			self.done = self.done + 1
 
+	def stats(self):
+		ret = {'depth': len(self.queue), 'queued': self.queued, 'done': self.done,
+					 'dropped': self.dropped, 'conflated': self.conflated,
+					 'errors': self.errors, 'lag': self.lag, 'max_lag': self.max_lag}
+		if hasattr(self.updater, 'stats'): ret.update(self.updater.stats())
+		return ret
 
+class ShellUpdate(Updater):
+	queuePolicy = kConflate
 
-def run():
-	try:
-		config.kStationType
-	except AttributeError:
-		print "Configuration Error:"
-		print
-		print "Please edit the config.py file and choose a Station Type. ('kStationType')"
-		return
+	def _update(self, sensor):
+		sensor.Display()
 
-	try:
-		config.kCommPort
-	except AttributeError:
-		print "Configuration Error:"
-		print
-		print "Please edit the config.py file and pick a Serial Port ('kCommPort')."
-		return
 
-	if config.kWundergroundUserID == "userid":
-		print "Configuration Error:"
-		print
-		print "Please edit the config.py file and enter your Wunderground "
-		print "Person Weather Station Userid and Password.  To sign up, "
-		print "visit: http://www.wunderground.com/weatherstation/usersignup.asp"
-		print
+## seconds between updates of a "module.Class" sink
+kSinkInterval = 10
+
+## Sinks config.kSinks can name: name -> (module, class, uploads,
+## setting, interval).  A sink's module is imported only when it is
+## enabled, sinks that upload are left out when running without uploads
+## and a sink with a setting is left out while that setting is off.
+## interval is the seconds between updates or the setting that holds
+## them.  Any other Updater can be named as "module.Class".
+kSinkTypes = {
+	'wunderground': ('wunderground', 'Wunderground', 1, None, 'kWunderground_UpdateInterval'),
+	'csv': ('csvupdate', 'CSVUpdate', 0, 'kCSVFile', 'kCSV_UpdateInterval'),
+	'shell': ('weather', 'ShellUpdate', 0, None, 'kShell_UpdateInterval'),
+	'server': ('weatherServer', 'SocketUpdater', 0, 'kWeatherServer', 5),
+	}
+
+## kSinks for a config without one
+kDefaultSinks = ['wunderground', 'csv', 'shell', 'server']
+
+def Sinks(config, upload=1):
+	"""[(name, Updater class, interval)] for the sinks in config.kSinks,
+	each entry a name or (name, interval in seconds).  Without an
+	interval it is read from config now, so site and station overrides
+	of the interval settings apply."""
+	sinks = getattr(config, 'kSinks', None)
+	if sinks is None: sinks = kDefaultSinks
+
+	ret = []
+	for sink in sinks:
+		interval = None
+		if type(sink) == type(()): sink, interval = sink
+		if kSinkTypes.has_key(sink):
+			modname, classname, uploads, setting, default = kSinkTypes[sink]
+		else:
+			i = string.rfind(sink, '.')
+			if i < 0: raise ValueError, "unknown sink %s" % sink
+			modname, classname, uploads, setting, default = sink[:i], sink[i+1:], 0, None, kSinkInterval
+		if uploads and not upload: continue
+		if setting and not getattr(config, setting, None): continue
+		if interval is None: interval = default
+		if type(interval) == type(''): interval = getattr(config, interval)
+
+		module = __import__(modname)
+		try:
+			klass = getattr(module, classname)
+		except AttributeError:
+			raise ValueError, "no %s in %s for sink %s" % (classname, modname, sink)
+		ret.append((sink, klass, interval))
+	return ret
+
+def AddSinks(logger, config, upload=1, sinks=None):
+	"""Add the sinks in config.kSinks, or sinks from Sinks(), to a
+	DataLogger."""
+	if sinks is None: sinks = Sinks(config, upload)
+	for (name, klass, interval) in sinks:
+		updater = klass(config, interval)
+		logger.SetUpdater(updater)
+		updater.start()
+
+def run(upload=1):
+	if getattr(config, 'kStations', None):
+		import multistation
+		multistation.run(config, upload)
 		return
-	
-	if config.kStationType == kStation_Davis:
-		import station_davis
-		module = station_davis
-	elif config.kStationType == kStation_Rainwise:
-		import station_rainwise
-		module = station_rainwise
-	elif config.kStationType == kStation_WM918:
-		import station_wm918
-		module = station_wm918
-	elif config.kStationType == kStation_WMR968:
-		import station_wmr968
-		module = station_wmr968
-
-	log("acquiring Serial Port")
-	cfg = module.GetSerialConfig(config)
-	port = serial.open(cfg)
-	wl = module.DataLogger(config, port)
-
-#	sleep_time = ((time.localtime(time.time())[4] / config.kWunderground_UpdateInterval) + 1) * config.kWunderground_UpdateInterval
-#	if sleep_time > 59: sleep_time = 60 - time.localtime(time.time())[4]
-#	else: sleep_time = sleep_time - time.localtime(time.time())[4]
-#	sleep_seconds = time.localtime(time.time())[5]
-#	log("Next update: " + str(sleep_seconds) + " seconds")
-#	wl.SetUpdater(Wunderground(config, ((sleep_time * 60) - sleep_seconds)))
-	wl.SetUpdater(Wunderground(config, config.kWunderground_UpdateInterval))
-	wl.SetUpdater(CSVUpdate(config, config.kCSV_UpdateInterval))
-	wl.SetUpdater(ShellUpdate(config, config.kShell_UpdateInterval))
-
-	if config.kWeatherServer:
-		import weatherServer
-		su = weatherServer.SocketUpdater(config, 5)
-		wl.SetUpdater(su)
-		su.run()
 
-	try:
-		while 1:
-			try:
-				wl.StartLoop()
-			except serial.TimeoutError, msg:
-				log("timeout error - pi")
-				import traceback
-				traceback.print_exc()
-				log(msg)
-			except CommError, msg:
-				log("comm error - pi")
-				import traceback
-				traceback.print_exc()
-				log("Communicatons Error", msg)
-	finally:
-		port.close()
+	StationLoop(upload).run()
+
+
+class StationLoop:
+	"""The acquisition loop of a single station.
+
+	The DataLogger is built by the first run() and kept.  Serial timeouts
+	and CommErrors go back to StartLoop(), which resumes LOOP polling;
+	anything else ends run() with the port closed, and the next run()
+	opens the port again for the same DataLogger, so the session and the
+	sample history outlive that too.
+	"""
+	def __init__(self, upload=1, logger=None):
+		self.upload = upload
+		self.logger = logger
+		self.runs = 0
+
+	def open(self):
+		"""Check the config and build the DataLogger and its sinks; None
+		after a configuration error."""
+		try:
+			config.kStationType
+		except AttributeError:
+			print "Configuration Error:"
+			print
+			print "Please edit the config.py file and choose a Station Type. ('kStationType')"
+			return None
+
+		try:
+			config.kCommPort
+		except AttributeError:
+			print "Configuration Error:"
+			print
+			print "Please edit the config.py file and pick a Serial Port ('kCommPort')."
+			return None
+
+		try:
+			sinks = Sinks(config, self.upload)
+		except (ValueError, ImportError), msg:
+			print "Configuration Error:"
+			print
+			print "Please check the sinks in config.py ('kSinks'):", msg
+			return None
+
+		if 'wunderground' in [name for (name, klass, interval) in sinks] and getattr(config, 'kWundergroundUserID', 'userid') == "userid":
+			print "Configuration Error:"
+			print
+			print "Please edit the config.py file and enter your Wunderground "
+			print "Person Weather Station Userid and Password.  To sign up, "
+			print "visit: http://www.wunderground.com/weatherstation/usersignup.asp"
+			print
+			return None
 	
+		if config.kStationType == kStation_Davis:
+			import station_davis
+			module = station_davis
+		elif config.kStationType == kStation_Rainwise:
+			import station_rainwise
+			module = station_rainwise
+		elif config.kStationType == kStation_WM918:
+			import station_wm918
+			module = station_wm918
+		elif config.kStationType == kStation_WMR968:
+			import station_wmr968
+			module = station_wmr968
+
+		log("acquiring Serial Port")
+		cfg = module.GetSerialConfig(config)
+		port = serial.open(cfg)
+		wl = module.DataLogger(config, port)
+
+#		sleep_time = ((time.localtime(time.time())[4] / config.kWunderground_UpdateInterval) + 1) * config.kWunderground_UpdateInterval
+#		if sleep_time > 59: sleep_time = 60 - time.localtime(time.time())[4]
+#		else: sleep_time = sleep_time - time.localtime(time.time())[4]
+#		sleep_seconds = time.localtime(time.time())[5]
+#		log("Next update: " + str(sleep_seconds) + " seconds")
+#		wl.SetUpdater(Wunderground(config, ((sleep_time * 60) - sleep_seconds)))
+		AddSinks(wl, config, self.upload, sinks)
+		return wl
+
+	def run(self):
+		"""Acquire until an error other than a timeout or a CommError;
+		returns only after a configuration error."""
+		wl = self.logger
+		if wl is None:
+			wl = self.open()
+			if wl is None: return
+			self.logger = wl
+		elif self.runs:
+			log("reopening Serial Port")
+			wl.Reopen()
+		self.runs = self.runs + 1
+
+		try:
+			while 1:
+				try:
+					wl.StartLoop()
+				except serial.TimeoutError, msg:
+					log("timeout error - pi")
+					import traceback
+					traceback.print_exc()
+					log(msg)
+				except CommError, msg:
+					log("comm error - pi")
+					import traceback
+					traceback.print_exc()
+					log("Communicatons Error", msg)
+		finally:
+			wl.port.close()
+
+
+def restart(run):
+	"""Call run() again after every error it raises."""
+	while 1:
+		try:  
+			run()
+			return
+		except KeyboardInterrupt:
+			raise
+		except:
+			import traceback
+			traceback.print_exc()
+			if sys.platform == "win32":
+				time.sleep(20)
 
 
 def usage(progname):
@@ -382,18 +1096,13 @@ def main(argv=sys.argv, stdout=sys.stdout, environ=os.environ):
 
 	debugfull()
 
-	while 1:
-		try:  
-			run()
-		except KeyboardInterrupt:
-			import traceback
-			traceback.print_exc()
-			return
-		except:
-			import traceback
-			traceback.print_exc()
-			if sys.platform == "win32":
-				time.sleep(20)
+	if getattr(config, 'kStations', None): loop = run
+	else: loop = StationLoop().run
+	try:
+		restart(loop)
+	except KeyboardInterrupt:
+		import traceback
+		traceback.print_exc()
 
 if __name__ == "__main__":
 	main(sys.argv, sys.stdout, os.environ)
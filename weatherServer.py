@@ -26,11 +26,11 @@ class SocketUpdater(weather.Updater):
 
 		buf9[0] = 0x9f
 		
-		itemp = weather_util.Fahrenheit2Celsius(sensor.inside_temp)
+		itemp = sensor.inside_temp_c
 		buf9[1] = weather_util.toBCD(int((itemp*10.) % 100))
 		buf9[2] = int((itemp % 100) / 10) 
 
-		otemp = weather_util.Fahrenheit2Celsius(sensor.outside_temp)
+		otemp = sensor.outside_temp_c
 		buf9[16] = weather_util.toBCD(int((otemp*10.) % 100))
 		buf9[17] = int((otemp % 100) / 10) 
 		
@@ -63,8 +63,8 @@ class SocketUpdater(weather.Updater):
 
 		## -----------------
 
-		barometer = weather_util.Inches2Millibars(sensor.barometer)
-		seabarometer = weather_util.Inches2Millibars(sensor.seabarometer)
+		barometer = sensor.barometer_mb
+		seabarometer = sensor.seabarometer_mb
 
 ##     log("barometer", barometer)
 ##     log("seabarometer", seabarometer)
@@ -75,7 +75,7 @@ class SocketUpdater(weather.Updater):
 		bufa[4] = weather_util.toBCD(int((seabarometer/10) % 100))
 		bufa[5] = weather_util.toBCD(int(seabarometer/1000))
 
-		dp = weather_util.Fahrenheit2Celsius(sensor.dewpoint)
+		dp = sensor.dewpoint_c
 		bufa[7] = weather_util.toBCD(int(dp))
 
 		checksum = 0
@@ -98,7 +98,7 @@ class SocketUpdater(weather.Updater):
 		bufc[3] = weather_util.toBCD(sensor.wind_direction / 10)
 		bufc[2] = (sensor.wind_direction % 10) << 4
 
-		wind_gust_speed = weather_util.MilesPerHour2MetersPerSecond(sensor.wind_gust_speed)
+		wind_gust_speed = sensor.wind_gust_speed_ms
 		bufc[1] = weather_util.toBCD(int(wind_gust_speed * 10 % 100))
 		bufc[2] = bufc[2] | int(wind_gust_speed / 10 % 1)
 
@@ -107,7 +107,7 @@ class SocketUpdater(weather.Updater):
 		bufc[5] = (sensor.wind_direction % 10) << 4
 
 
-		wind_speed = weather_util.MilesPerHour2MetersPerSecond(sensor.wind_speed)
+		wind_speed = sensor.wind_speed_ms
 		bufc[4] = weather_util.toBCD(int((wind_speed * 10) % 100))
 		bufc[5] = bufc[5] | int(wind_speed / 10 % 1)
 
@@ -189,6 +189,9 @@ class SocketUpdater(weather.Updater):
 		self.pid = pid
 		return
 
+	def start(self):
+		self.run()
+
 	def run(self):
 		try:
 			import thread
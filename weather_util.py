@@ -47,6 +47,40 @@ def MilesPerHour2MetersPerSecond(mph):
 
 ## ----------------------------------------------
 
+def _monotonic_clock():
+	try:
+		return time.monotonic
+	except AttributeError:
+		pass
+
+	try:
+		import ctypes, ctypes.util
+
+		class timespec(ctypes.Structure):
+			_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+		lib = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+		clock_gettime = lib.clock_gettime
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		ts = timespec()
+		CLOCK_MONOTONIC = 1
+
+		def monotonic():
+			if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+				return time.time()
+			return ts.tv_sec + ts.tv_nsec * 1e-9
+
+		monotonic()
+		return monotonic
+	except (ImportError, OSError, AttributeError, TypeError):
+		return time.time
+
+## seconds from an arbitrary start point; never jumps when the wall
+## clock is set
+monotonic = _monotonic_clock()
+
+## ----------------------------------------------
+
 BCDError = "BCDError"
 
 def toBCD(n):
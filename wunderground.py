@@ -0,0 +1,236 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args]
+
+	Uploads to Weather Underground.  Run on its own it sends what is
+	waiting in config.kWunderground_Spool and exits when that is done.
+"""
+
+
+import os, sys, string, time, getopt, urllib
+from log import *
+
+import weather
+
+
+## Weather Underground upload hosts; kWunderground_Host overrides them
+kWundergroundHost = "weatherstation.wunderground.com"
+kWundergroundRealTimeHost = "rtupdate.wunderground.com"
+
+## seconds between RapidFire uploads
+kRealTimeInterval = 5
+
+## seconds to wait on the kept-alive upload connection
+kWundergroundTimeout = 10
+
+
+class Wunderground(weather.Updater):
+	"""Uploads to Weather Underground every updateInterval seconds, or in
+	RapidFire mode (kWunderground_RealTime) every
+	kWunderground_RealTimeInterval seconds over one kept-alive connection.
+
+	With kWunderground_Spool set, uploads that fail and samples recovered
+	from the archive go to a spool.Spool, and a spool.Replayer sends them
+	with their own dateutc on a second connection once uploads get
+	through again.
+	"""
+	queuePolicy = weather.kConflate
+	inlineBackfill = 1
+
+	def __init__(self, config, updateInterval=10):
+		self.realtime = getattr(config, 'kWunderground_RealTime', 0)
+		if self.realtime:
+			updateInterval = getattr(config, 'kWunderground_RealTimeInterval', kRealTimeInterval)
+			host = kWundergroundRealTimeHost
+		else:
+			host = kWundergroundHost
+		weather.Updater.__init__(self, config, updateInterval)
+
+		## update() runs once per sample, so uploads go out no faster than
+		## samples are taken; that is the frequency the server is told
+		self.rtfreq = updateInterval
+		if self.realtime:
+			every = getattr(config, 'kUpdateInterval', updateInterval)
+			if every > updateInterval:
+				warn("RapidFire every %ss, but samples are only taken every %ss (kUpdateInterval)" % (updateInterval, every))
+				self.rtfreq = every
+		self.host = getattr(config, 'kWunderground_Host', None) or host
+		self.conn = None
+
+		self.spool = None
+		self.replayer = None
+		self.replayConn = None
+		path = getattr(config, 'kWunderground_Spool', None)
+		if path and getattr(config, 'kWundergroundUserID', 'userid') != 'userid':
+			import spool
+			self.spool = spool.Spool(path)
+			self.replayer = spool.Replayer(self.spool, self.replay,
+																		 getattr(config, 'kSpool_Batch', spool.kBatch),
+																		 getattr(config, 'kSpool_Rate', spool.kRate))
+			if len(self.spool): log("Wunderground spool:", len(self.spool), "uploads waiting")
+
+	def query(self, sensor):
+		"""the observation part of an upload, as kept in the spool"""
+		utc = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(sensor.sample_time))
+
+		return "dateutc=%s&winddir=%s&windspeedmph=%s&windgustmph=%s&tempf=%.1f&rainin=%.2f&baromin=%.2f&dewptf=%.2f&humidity=%s&indoortempf=%.1f&indoorhumidity=%s" % (urllib.quote(utc), sensor.wind_direction, sensor.wind_speed, sensor.max_wind_speed, sensor.outside_temp, sensor.rain_diff, sensor.barometer, sensor.dewpoint, sensor.outside_humidity, sensor.inside_temp, sensor.inside_humidity)
+
+	def path(self, query, realtime=0):
+		path = "/weatherstation/updateweatherstation.php?ID=%s&PASSWORD=%s&%s&softwaretype=%s&action=updateraw" % (urllib.quote(self.config.kWundergroundUserID), urllib.quote(self.config.kWundergroundPassword), query, urllib.quote(weather._version))
+		if realtime:
+			path = path + "&realtime=1&rtfreq=%d" % self.rtfreq
+		return path
+
+	def _update(self, sensor):
+		if self.config.kWundergroundUserID == 'userid': return
+
+		if sensor.sample_time == 0: 
+			warn("sample_time is zero")
+			return
+
+		query = self.query(sensor)
+		path = self.path(query, self.realtime)
+
+		if self.realtime:
+			import fhttplib
+			if self.conn is None:
+				self.conn = fhttplib.KeepAliveHTTP(self.host, timeout=kWundergroundTimeout)
+			try:
+				answered, ok = self.send(self.conn, [path])
+			except:
+				import traceback
+				traceback.print_exc()
+				answered = 0
+			self.sent(query, answered)
+			return
+
+		host = self.host
+		port = 0						## from host, else 80
+		url = "http://" + host + path
+
+		answered = 0
+		if 1:
+			try:  
+#				sleep_time = (((time.localtime(time.time())[4] / config.kWunderground_UpdateInterval) + 1) * config.kWunderground_UpdateInterval);
+#				if sleep_time > 59: sleep_time = 60 - time.localtime(time.time())[4];
+#				else: sleep_time = sleep_time - time.localtime(time.time())[4];
+#				sleep_seconds = time.localtime(time.time())[5];
+#				sleep_time = (sleep_time * 60) - sleep_seconds;
+#				m, s = divmod(sleep_time, 60);
+#				log("uploading to Wunderground.com.  Next update in: " + str(m) + ":" + str(s));
+				log("uploading to Wunderground.com.");
+
+				if 1:
+					import fhttplib
+					h = fhttplib.aHTTP (host, port, timeout=10)
+
+					h.putrequest("GET", path)
+					h.putheader("Host", host)
+					h.endheaders()
+
+					errcode, errmsg, headers = h.getreply()
+
+					f = h.getfile()
+					page = f.read()
+					f.close()
+					answered = errcode > 0 and errcode < 500
+
+				if 0:
+					fp = urllib.urlopen(url)
+					page = fp.read()
+					fp.close()
+			except:
+				import traceback
+				traceback.print_exc()
+		self.sent(query, answered)
+
+	def sent(self, query, answered):
+		"""An upload went through or it goes in the spool."""
+		if self.spool is None: return
+		if answered: self.replayer.wake()
+		else: self.spool.append(query)
+
+	def backfill(self, sensor):
+		if self.spool is not None and sensor.sample_time:
+			self.spool.append(self.query(sensor))
+
+	def send(self, h, paths):
+		"""Pipeline the uploads in paths over h, a kept-alive connection.
+		Returns how many of them, from the front, got an answer and how
+		many of those the server took.  A server error ends the batch and
+		a connection that fails before the first answer raises."""
+		answered = 0
+		ok = 0
+		try:
+			for path in paths:
+				h.request("GET", path)
+			h.flush()
+
+			for path in paths:
+				errcode, errmsg, headers = h.getreply()
+				page = h.getfile().read()
+				if errcode >= 500:
+					warn("Wunderground server error:", errcode, errmsg)
+					h.reset()
+					break
+				answered = answered + 1
+				if errcode == 200 and page[:7] == "success":
+					ok = ok + 1
+				else:
+					warn("Wunderground upload failed:", errcode, errmsg, string.strip(page)[:80])
+		except:
+			h.reset()
+			if not answered: raise
+			warn("Wunderground connection lost after", answered, "of", len(paths), "uploads:", sys.exc_info()[1])
+		return answered, ok
+
+	def replay(self, queries):
+		"""spool.Replayer's send(): the spooled uploads, with their own
+		dateutc, on a connection of their own"""
+		import fhttplib
+		if self.replayConn is None:
+			host = getattr(self.config, 'kWunderground_Host', None) or kWundergroundHost
+			self.replayConn = fhttplib.KeepAliveHTTP(host, timeout=kWundergroundTimeout)
+		paths = []
+		for query in queries:
+			paths.append(self.path(query))
+		answered, ok = self.send(self.replayConn, paths)
+		return answered
+
+	def stats(self):
+		if self.replayer is None: return {}
+		ret = {}
+		for (k, v) in self.replayer.stats().items():
+			ret['spool_' + k] = v
+		return ret
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help"])
+
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+
+	debugon()
+	config = weather.config
+	w = Wunderground(config, config.kWunderground_UpdateInterval)
+	if w.spool is None:
+		warn("no kWunderground_Spool (or no kWundergroundUserID) in the config")
+		return
+	log(len(w.spool), "uploads waiting in", w.spool.path)
+	while len(w.spool):
+		time.sleep(1)
+	log(w.stats())
+	w.spool.close()
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)
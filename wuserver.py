@@ -0,0 +1,133 @@
+#! /usr/local/bin/python --
+
+"""
+usage: %(progname)s [args]
+
+	A stand-in for the Wunderground upload servers, to test against with
+	kWunderground_Host = "localhost:8080".  Answers updateweatherstation.php
+	over HTTP/1.1 keep-alive, pipelining included, and logs every upload
+	with the connection it came in on.
+
+	--port=N     port to listen on (default 8080)
+	--close      close the connection after every reply
+	--delay=S    seconds to wait before each reply
+	--fail=N     answer every Nth upload with a 500
+"""
+
+
+import os, sys, string, time, getopt, cgi, threading
+import BaseHTTPServer, SocketServer
+from log import *
+
+
+kPort = 8080
+
+kPath = "/weatherstation/updateweatherstation.php"
+
+
+class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	## a reply goes out in one write, as a real server's would
+	wbufsize = -1
+
+	def setup(self):
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+		server = self.server
+		server.lock.acquire()
+		server.connections = server.connections + 1
+		self.connection_id = server.connections
+		server.lock.release()
+		self.requests = 0
+
+	def do_GET(self):
+		server = self.server
+		self.requests = self.requests + 1
+		path, q, query = self.path.partition("?")
+		args = cgi.parse_qs(query)
+
+		server.lock.acquire()
+		server.uploads = server.uploads + 1
+		n = server.uploads
+		server.lock.release()
+
+		if server.delay: time.sleep(server.delay)
+
+		code = 200
+		if path != kPath:
+			code, body = 404, "not found\n"
+		elif not args.has_key('ID') or not args.has_key('PASSWORD') or not args.has_key('dateutc'):
+			code, body = 400, "INVALIDPASSWORDID|Password and/or id are incorrect\n"
+		elif server.fail and n % server.fail == 0:
+			code, body = 500, "server error\n"
+		else:
+			body = "success\n"
+
+		mode = "interval"
+		if args.has_key('rtfreq'): mode = "realtime/%s" % args['rtfreq'][0]
+		log("upload", n, "conn", self.connection_id, "request", self.requests, code,
+				args.get('dateutc', ['-'])[0], mode, "tempf=%s" % args.get('tempf', ['-'])[0])
+
+		self.send_response(code)
+		self.send_header("Content-Type", "text/plain")
+		self.send_header("Content-Length", str(len(body)))
+		if server.close:
+			self.send_header("Connection", "close")
+			self.close_connection = 1
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class UploadServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = 1
+	allow_reuse_address = 1
+
+	def __init__(self, address, close=0, delay=0, fail=0):
+		BaseHTTPServer.HTTPServer.__init__(self, address, UploadHandler)
+		self.close = close
+		self.delay = delay
+		self.fail = fail
+		self.lock = threading.Lock()
+		self.connections = 0
+		self.uploads = 0
+
+
+
+def usage(progname):
+	print __doc__ % vars()
+
+def main(argv, stdout, environ):
+	progname = argv[0]
+	list, args = getopt.getopt(argv[1:], "", ["help", "port=", "close", "delay=", "fail="])
+
+	port = kPort
+	close = 0
+	delay = 0
+	fail = 0
+	for (field, val) in list:
+		if field == "--help":
+			usage(progname)
+			return
+		elif field == "--port":
+			port = int(val)
+		elif field == "--close":
+			close = 1
+		elif field == "--delay":
+			delay = float(val)
+		elif field == "--fail":
+			fail = int(val)
+
+	debugon()
+	server = UploadServer(('', port), close, delay, fail)
+	log("listening on port", port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	log(server.uploads, "uploads on", server.connections, "connections")
+
+
+if __name__ == "__main__":
+	main(sys.argv, sys.stdout, os.environ)